@@ -8,6 +8,7 @@ import { ExchangeMessageData, GPTResponseData } from '../types/index.js'
 import { chatGPTAPI } from './chatgpt-api.mjs'
 import { WebsocketClient } from './websocket-client.mjs'
 import { textToVoice } from './text-to-voice.mjs'
+import { waitForPicture } from './picture-job.mjs'
 import PromiseQueue from '../utils/promise-queue.mjs'
 import { splitParagraphToShorterParts } from '../utils/text.mjs'
 
@@ -63,7 +64,11 @@ class App {
           console.log('chatGPTAPI.sendMessage result', result)
           await this.parentMessageIds?.set(data.chat.id, result.id)
 
-          const { content: textContent, imageBase64: imageContent } = JSON.parse(result.text) as GPTResponseData
+          const {
+            content: textContent,
+            imageBase64: imageContent,
+            imageJobId,
+          } = JSON.parse(result.text) as GPTResponseData
           const textContentParts = splitParagraphToShorterParts(textContent)
           const queue = new PromiseQueue()
 
@@ -112,7 +117,7 @@ class App {
             })
           })
 
-          if (imageContent !== '') {
+          const replyImage = (image: string) => {
             queue.add(async () => {
               // reply image
               this.websocketClient.replyMessageRequest({
@@ -120,13 +125,24 @@ class App {
                 chat: data.chat,
                 message: {
                   type: 'image',
-                  content: imageContent,
+                  content: image,
                   id: data.message.id,
                 },
                 options: data.options,
               })
             })
           }
+
+          if (imageContent !== '') {
+            replyImage(imageContent)
+          } else if (imageJobId !== undefined) {
+            // the picture follows the text once it is ready
+            waitForPicture(imageJobId).then((image) => {
+              if (image !== '') {
+                replyImage(image)
+              }
+            })
+          }
         })
         .catch((e) => {
           console.log('chatGPTAPI.sendMessage error', e)
@@ -0,0 +1,34 @@
+import axios from 'axios'
+import _ from 'lodash'
+import dotenv from 'dotenv'
+
+import { sleep } from '../utils/sleep.mjs'
+
+dotenv.config()
+
+const POLL_INTERVAL = 1000
+const POLL_TIMEOUT = 5 * 60 * 1000
+
+// The picture of a reply is made in the background by the GPT server, poll it until it is done.
+// Resolves to '' when no picture was needed.
+export const waitForPicture = async (jobId: string): Promise<string> => {
+  const start = Date.now()
+  while (Date.now() - start < POLL_TIMEOUT) {
+    const result = await axios
+      // @ts-ignore
+      .get(`${process.env.GPT_SERVER}/v1/images/jobs/${jobId}`)
+      .catch((e) => {
+        console.log('call waitForPicture failed', e.message)
+        return undefined
+      })
+    if (result === undefined) {
+      return ''
+    }
+    if (result.data?.status !== 'pending') {
+      console.log('picture job finished', jobId, result.data?.status, Date.now() - start)
+      return _.isEmpty(result.data?.imageBase64) ? '' : result.data.imageBase64
+    }
+    await sleep(POLL_INTERVAL)
+  }
+  return ''
+}
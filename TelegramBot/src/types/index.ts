@@ -18,4 +18,5 @@ export interface ExchangeMessageData {
 export interface GPTResponseData {
   content: string
   imageBase64: string
+  imageJobId?: string
 }
@@ -2,3 +2,32 @@ document.getElementById("main").childNodes[0].style = "max-width: 800px; margin-
 document.getElementById("extensions").style.setProperty("max-width", "800px");
 document.getElementById("extensions").style.setProperty("margin-left", "auto");
 document.getElementById("extensions").style.setProperty("margin-right", "auto");
+
+// Patches the chat display with a delta streamed by --chat-delta-streaming
+let chatDelta = {stream: -1, seq: -1};
+window.applyChatDelta = function(x) {
+    if (!x) {
+        return;
+    }
+
+    let delta = JSON.parse(x);
+    let chat = document.getElementById('chat');
+    if (chat === null) {
+        return;
+    }
+
+    if (delta.remove < 0) {
+        chat.innerHTML = delta.html;
+    } else if (delta.stream === chatDelta.stream && delta.seq === chatDelta.seq + 1) {
+        // The messages are newest first
+        for (let i = 0; i < delta.remove && chat.firstElementChild !== null; i++) {
+            chat.firstElementChild.remove();
+        }
+        chat.insertAdjacentHTML('afterbegin', delta.html);
+    } else {
+        // A delta was missed, the whole chat is redrawn when the reply ends
+        return;
+    }
+
+    chatDelta = {stream: delta.stream, seq: delta.seq};
+};
@@ -0,0 +1,114 @@
+'''
+
+Asyncio version of the OpenAI compatible API (OPENEDAI_ASYNC=1).
+
+One event loop serves every connection with HTTP/1.1 keep-alive instead of
+a thread per request. Tokens are still generated by the scheduler's worker
+thread; it pushes the replies into an asyncio queue per request, and the
+server-sent events are written as soon as they arrive. If the client goes
+away in the middle of a stream, the request is cancelled at the next
+decode step.
+
+Needs uvicorn and starlette (see requirements.txt).
+
+'''
+
+import asyncio
+import json
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Route
+
+from modules import metrics
+
+import extensions.openai.script as script
+from extensions.openai.completions import Completion, debug
+
+
+def json_response(response):
+    return Response(response, media_type='application/json')
+
+
+async def completion_stream(completion):
+    loop = asyncio.get_running_loop()
+    try:
+        for response in completion.start(loop=loop):
+            yield response
+
+        async for a in completion.generator:
+            pieces, stopped = completion.feed(a)
+            for response in pieces:
+                yield response
+
+            if stopped:
+                break
+    finally:
+        # Also reached when starlette notices the disconnect and closes the stream
+        completion.cancel()
+
+    for response in await run_in_threadpool(completion.finish):
+        yield response
+
+
+async def get(request: Request):
+    path = request.url.path
+    if path == '/metrics':
+        return Response(metrics.render(), media_type=script.metrics_content_type)
+    elif path.startswith('/v1/models'):
+        return json_response(script.models_response(path))
+    elif '/images/jobs/' in path:
+        response = script.picture_job_response(path)
+        if response is not None:
+            return json_response(response)
+
+    return Response(status_code=404)
+
+
+async def post(request: Request):
+    path = request.url.path
+    body = json.loads(await request.body())
+
+    if debug:
+        print(request.headers)
+        print(body)
+
+    if '/completions' in path or '/generate' in path:
+        # Building the prompt tokenizes the history, keep it off the event loop
+        completion = await run_in_threadpool(Completion, path, body)
+        if completion.stream:
+            return StreamingResponse(completion_stream(completion), media_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+        pieces = [response async for response in completion_stream(completion)]
+        return json_response(''.join(pieces))
+    elif '/embeddings' in path and script.embedding_model is not None:
+        return json_response(await run_in_threadpool(script.embeddings_response, body))
+    elif '/moderations' in path:
+        return json_response(script.moderations_response())
+    elif path == '/api/v1/token-count':
+        return json_response(await run_in_threadpool(script.token_count_response, body))
+
+    print(path, request.headers)
+    return Response(status_code=404)
+
+
+app = Starlette(routes=[
+    Route('/{path:path}', get, methods=['GET']),
+    Route('/{path:path}', post, methods=['POST']),
+])
+
+
+class AsyncServer:
+    def __init__(self, server_addr):
+        config = uvicorn.Config(app, host=server_addr[0], port=server_addr[1], log_level='warning')
+        self.server = uvicorn.Server(config)
+
+    def serve_forever(self):
+        self.server.run()
+
+
+def make_server(server_addr):
+    return AsyncServer(server_addr)
@@ -0,0 +1,455 @@
+'''
+
+The /completions and /chat/completions logic, independent of the HTTP
+server that receives the request.
+
+A Completion builds the prompt and the generation parameters from the
+request body, and turns the replies of the scheduler into response bodies:
+one json document, or a list of server-sent events when streaming. Both the
+threaded server and the asyncio server drive it.
+
+'''
+
+import json
+import os
+import time
+
+from modules import shared
+from modules.model_registry import registry
+from modules.stop_matcher import TextStopMatcher
+from modules.text_generation import count_tokens_batch
+import extensions.openai.character_utils as character_utils
+import extensions.openai.createpic as picgenerate
+import extensions.openai.memory as memory
+import extensions.openai.scheduler as scheduler
+import extensions.openai.sessions as sessions
+
+debug = True if 'OPENEDAI_DEBUG' in os.environ else False
+debug=True
+
+standard_stopping_strings = ['\nsystem:', '\nuser:', '\nhuman:', '\nassistant:','\n###', ]
+name1=""; name2="";  greeting="";  context=""
+
+
+# little helper to get defaults if arg is present but None and should be the same type as default.
+def default(dic, key, default):
+    val = dic.get(key, default)
+    if type(val) != type(default):
+        # maybe it's just something like 1 instead of 1.0
+        try:
+            v = type(default)(val)
+            if type(val)(v) == val:  # if it's the same value passed in, it's ok.
+                return v
+        except:
+            pass
+
+        val = default
+    return val
+
+
+def clamp(value, minvalue, maxvalue):
+    return max(minvalue, min(value, maxvalue))
+
+
+def load_character(character):
+    global name1, name2, greeting, context
+    name1, name2, greeting, context = character_utils.load_character(character)
+
+
+class Completion:
+    def __init__(self, path, body):
+        self.is_legacy = '/generate' in path
+        self.is_chat = 'chat' in path
+        self.resp_list = 'data' if self.is_legacy else 'choices'
+
+        # Names that aren't in the models folder (gpt-3.5-turbo...) go to the default model
+        self.model = registry.resolve(body.get('model'))
+        # The model generating may be another one, so the tokens are counted with this model's tokenizer
+        self.tokenizer = registry.tokenizer(self.model)
+        self.created_time = int(time.time())
+        self.cmpl_id = "conv-%d" % (self.created_time)
+
+        # Try to use openai defaults or map them to something with the same intent
+        stopping_strings = default(shared.settings, 'custom_stopping_strings', [])
+        if 'stop' in body:
+            if isinstance(body['stop'], str):
+                stopping_strings = [body['stop']]
+            elif isinstance(body['stop'], list):
+                stopping_strings = body['stop']
+
+        truncation_length = default(shared.settings, 'truncation_length', 2048)
+        truncation_length = clamp(default(body, 'truncation_length', truncation_length), 1, truncation_length)
+
+        default_max_tokens = truncation_length if self.is_chat else 16  # completions default, chat default is 'inf' so we need to cap it., the default for chat is "inf"
+
+        max_tokens_str = 'length' if self.is_legacy else 'max_tokens'
+        max_tokens = default(body, max_tokens_str, default(shared.settings, 'max_new_tokens', default_max_tokens))
+
+        # hard scale this, assuming the given max is for GPT3/4, perhaps inspect the requested model and lookup the context max
+        while truncation_length <= max_tokens:
+            max_tokens = max_tokens // 2
+
+        req_params = {
+            'max_new_tokens': max_tokens,
+            'temperature': default(body, 'temperature', 0.72),
+            'top_p': default(body, 'top_p', 0.73),
+            'top_k': default(body, 'best_of', 0),
+            # XXX not sure about this one, seems to be the right mapping, but the range is different (-2..2.0) vs 0..2
+            # 0 is default in openai, but 1.0 is default in other places. Maybe it's scaled? scale it.
+            'repetition_penalty': 1.18,  # (default(body, 'presence_penalty', 0) + 2.0 ) / 2.0, # 0 the real default, 1.2 is the model default, but 1.18 works better.
+            # XXX not sure about this one either, same questions. (-2..2.0), 0 is default not 1.0, scale it.
+            'encoder_repetition_penalty': 1.0,  # (default(body, 'frequency_penalty', 0) + 2.0) / 2.0,
+            'suffix': body.get('suffix', None),
+            'stream': default(body, 'stream', False),
+            'echo': default(body, 'echo', False),
+            #####################################################
+            'seed': shared.settings.get('seed', -1),
+            # int(body.get('n', 1)) # perhaps this should be num_beams or chat_generation_attempts? 'n' doesn't have a direct map
+            # unofficial, but it needs to get set anyways.
+            'truncation_length': truncation_length,
+            # no more args.
+            'add_bos_token': shared.settings.get('add_bos_token', True),
+            'do_sample': True,
+            'typical_p': 1.0,
+            'min_length': 0,
+            'no_repeat_ngram_size': 0,
+            'num_beams': 1,
+            'penalty_alpha': 0.0,
+            'length_penalty': 1,
+            'early_stopping': False,
+            'ban_eos_token': False,
+            'skip_special_tokens': True,
+            'context':context,
+            'greeting':greeting,
+            'mode':self.model,
+            'name1':name1,
+            'name2':name2,
+            "chat_prompt_size":2048
+        }
+        #
+        # fixup absolute 0.0's
+        for par in ['temperature', 'repetition_penalty', 'encoder_repetition_penalty']:
+            req_params[par] = clamp(req_params[par], 0.001, 1.999)
+
+        self.req_params = req_params
+        self.stream = req_params['stream']
+        self.token_count = 0
+        self.messages_for_pic = []
+        self.conversation = None
+        self.memory_index = None
+        if self.is_chat and body.get('conversation_id') is not None:
+            self.conversation = sessions.store.open(str(body['conversation_id']), self.model)
+
+        if self.is_chat:
+            self.stream_object_type = 'chat.completions.chunk'
+            self.object_type = 'chat.completions'
+
+            messages = body['messages']
+
+            system_msg = ''  # You are ChatGPT, a large language model trained by OpenAI. Answer as concisely as possible. Knowledge cutoff: {knowledge_cutoff} Current date: {current_date}
+            if 'prompt' in body:  # Maybe they sent both? This is not documented in the API, but some clients seem to do this.
+                system_msg = body['prompt']
+
+            chat_msgs = []
+
+            for m in messages:
+                role = m['role']
+                content = m['content']
+                # name = m.get('name', 'user')
+                if role == 'system':
+                    system_msg += content
+                else:
+                    chat_msgs.extend([f"\n{role}: {content.strip()}"])  # Strip content? linefeed?
+                    self.messages_for_pic.append(m)
+
+            # The messages are mostly the same from one request to the next, so their
+            # token counts are cached, and the new ones are tokenized in a single batch.
+            chat_msgs = [character_utils.replace_openai_names(msg, req_params['name1'], req_params['name2']) for msg in chat_msgs]
+            if self.conversation is not None:
+                # Only the new messages were sent, the rest of the history is on the server
+                if self.conversation.model != self.model:
+                    self.conversation.recount(self.model, self._count_tokens_batch)
+
+                self.conversation.extend(system_msg, chat_msgs, self._count_tokens_batch(chat_msgs) if chat_msgs else [], self.messages_for_pic)
+                sessions.store.save(self.conversation)
+                system_msg, chat_msgs, msg_token_counts, self.messages_for_pic = self.conversation.snapshot()
+                system_token_count = self._count_tokens_batch([system_msg if system_msg else req_params['context']])[0]
+            else:
+                msg_token_counts = self._count_tokens_batch([system_msg if system_msg else req_params['context']] + chat_msgs)
+                system_token_count = msg_token_counts.pop(0)
+
+            remaining_tokens = req_params['truncation_length'] - req_params['max_new_tokens'] - system_token_count
+            memory_tokens = 0
+            if memory.is_enabled(body):
+                self.memory_index = memory.get_index(body)
+                memory.remember(self.memory_index, chat_msgs)
+                # Room for the recalled messages, only needed when the history doesn't fit
+                if sum(msg_token_counts) > remaining_tokens:
+                    memory_tokens = min(memory.params['max_tokens'], remaining_tokens // 2)
+                    remaining_tokens -= memory_tokens
+
+            all_msgs = list(chat_msgs)
+            chat_msg = ''
+            while chat_msgs:
+                new_msg = chat_msgs.pop()
+                new_size = msg_token_counts.pop()
+                if new_size <= remaining_tokens:
+                    chat_msg = new_msg + chat_msg
+                    remaining_tokens -= new_size
+                else:
+                    # TODO: clip a message to fit?
+                    # ie. user: ...<clipped message>
+                    break
+
+            if len(chat_msgs) > 0:
+                print(f"truncating chat messages, dropping {len(chat_msgs)} messages.")
+                if memory_tokens > 0 and len(chat_msgs) < len(all_msgs):
+                    chat_msg = self._recall(all_msgs[-1], all_msgs[len(chat_msgs):], memory_tokens) + chat_msg
+
+            if system_msg:
+                prompt = 'system: ' + system_msg + '\n' + chat_msg + '\nassistant: '
+            else:
+                # prompt = chat_msg + '\nassistant: '
+                prompt = req_params['context']+ chat_msg + '\n'+req_params['name2']+':'
+
+            # pass with some expected stop strings.
+            # some strange cases of "##| Instruction: " sneaking through.
+            stopping_strings += standard_stopping_strings
+            stopping_strings+=character_utils.get_stopping_strings(req_params)
+            req_params['custom_stopping_strings'] = stopping_strings
+        else:
+            self.stream_object_type = 'text_completion.chunk'
+            self.object_type = 'text_completion'
+
+            # ... encoded as a string, array of strings, array of tokens, or array of token arrays.
+            if self.is_legacy:
+                prompt = body['context']  # Older engines.generate API
+            else:
+                prompt = body['prompt']  # XXX this can be different types
+
+            if isinstance(prompt, list):
+                prompt = ''.join(prompt)  # XXX this is wrong... need to split out to multiple calls?
+
+            self.token_count = self._count_tokens(prompt)
+            if self.token_count >= req_params['truncation_length']:
+                new_len = int(len(prompt) * (float(shared.settings['truncation_length']) - req_params['max_new_tokens']) / self.token_count)
+                prompt = prompt[-new_len:]
+                print(f"truncating prompt to {new_len} characters, was {self.token_count} tokens. Now: {self._count_tokens(prompt)} tokens.")
+
+            # pass with some expected stop strings.
+            # some strange cases of "##| Instruction: " sneaking through.
+            stopping_strings += standard_stopping_strings
+            req_params['custom_stopping_strings'] = stopping_strings
+
+        self.prompt = prompt
+        self.stopping_strings = stopping_strings
+        self.stop_matcher = TextStopMatcher(stopping_strings)
+        self.generator = None
+        self.answer = ''
+        self.seen_content = ''
+
+    def _chunk(self, finish_reason=None):
+        return {
+            "id": self.cmpl_id,
+            "object": self.stream_object_type,
+            "created": self.created_time,
+            "model": self.model,  # TODO: add Lora info?
+            self.resp_list: [{
+                "index": 0,
+                "finish_reason": finish_reason,
+            }],
+        }
+
+    def start(self, loop=None):
+        '''
+        Queues the request on the generation worker and returns the events
+        to send before the first token. With an asyncio loop, the replies
+        are delivered through an asyncio queue instead of a blocking one.
+        '''
+        if debug:
+            print({'prompt': self.prompt, 'req_params': self.req_params, 'stopping_strings': self.stopping_strings})
+
+        # Conversations kept on the server also keep the keys and values of the reply
+        self.generator = scheduler.generate(self.prompt, self.req_params, stopping_strings=self.stopping_strings, loop=loop, keep_cache=self.conversation is not None, model=self.model)
+        if not self.stream:
+            return []
+
+        shared.args.chat = True
+        # begin streaming
+        chunk = self._chunk()
+        if self.stream_object_type == 'text_completion.chunk':
+            chunk[self.resp_list][0]["text"] = ""
+        else:
+            # This is coming back as "system" to the openapi cli, not sure why.
+            # So yeah... do both methods? delta and messages.
+            chunk[self.resp_list][0]["message"] = {'role': 'assistant', 'content': ''}
+            chunk[self.resp_list][0]["delta"] = {'role': 'assistant', 'content': ''}
+            # { "role": "assistant" }
+
+        return ['data: ' + json.dumps(chunk) + '\n']
+
+    def feed(self, a):
+        '''
+        Takes the next cumulative reply of the generator. Returns the events
+        to send for it and whether a stopping string ended the reply.
+        '''
+        if isinstance(a, str):
+            answer = a
+        else:
+            answer = a[0]
+
+        self.answer = answer
+        stop_idx, pending = self.stop_matcher.update(answer)
+        if stop_idx is not None:
+            self.answer = answer[:stop_idx]  # clip it.
+            return [], True
+
+        # If something like "\nYo" is generated just before "\nYou:"
+        # is completed, buffer and generate more, don't send it
+        if pending > 0 or not self.stream:
+            return [], False
+
+        new_content = answer[len(self.seen_content):]
+        if not new_content or chr(0xfffd) in new_content:  # partial unicode character, don't send it yet.
+            return [], False
+
+        self.seen_content = answer
+        chunk = self._chunk()
+        if self.stream_object_type == 'text_completion.chunk':
+            chunk[self.resp_list][0]['text'] = new_content
+        else:
+            # So yeah... do both methods? delta and messages.
+            chunk[self.resp_list][0]['message'] = {'content': new_content}
+            chunk[self.resp_list][0]['delta'] = {'content': new_content}
+
+        return ['data: ' + json.dumps(chunk) + '\n'], False
+
+    def cancel(self):
+        # Stops generating if the client went away or a stop string was found
+        if self.generator is not None:
+            self.generator.cancel()
+
+    def finish(self):
+        '''
+        Returns the final event (streaming) or the whole json response.
+        In chat mode with SD_ASYNC_PICTURES=0 this waits for the picture.
+        '''
+        generator = self.generator
+        answer = self.answer
+        if self.is_chat:
+            # The prompt was tokenized by the scheduler, don't do it again
+            self.token_count = generator.prompt_tokens if generator.prompt_tokens is not None else self._count_tokens(self.prompt)
+
+        # Counted by the scheduler as the tokens were generated
+        token_count = self.token_count
+        completion_token_count = generator.completion_tokens if generator.completion_tokens is not None else self._count_tokens(answer)
+        usage = {
+            "prompt_tokens": token_count,
+            "completion_tokens": completion_token_count,
+            "total_tokens": token_count + completion_token_count
+        }
+
+        if debug:
+            print({'response': answer})
+
+        if generator.finish_reason != 'cancelled':
+            self._remember_reply(answer)
+
+        if self.stream:
+            chunk = self._chunk("stop")
+            chunk["usage"] = usage
+            if self.conversation is not None:
+                chunk["conversation_id"] = self.conversation.id
+            if self.stream_object_type == 'text_completion.chunk':
+                chunk[self.resp_list][0]['text'] = ''
+            else:
+                # So yeah... do both methods? delta and messages.
+                chunk[self.resp_list][0]['message'] = {'content': ''}
+                chunk[self.resp_list][0]['delta'] = {}
+
+            return ['data: ' + json.dumps(chunk) + '\ndata: [DONE]\n']
+
+        stop_reason = "stop"
+        if token_count + completion_token_count >= self.req_params['truncation_length']:
+            stop_reason = "length"
+
+        resp = {
+            "id": self.cmpl_id,
+            "object": self.object_type,
+            "created": self.created_time,
+            "model": self.model,  # TODO: add Lora info?
+            self.resp_list: [{
+                "index": 0,
+                "finish_reason": stop_reason,
+            }],
+            "usage": usage
+        }
+        if self.conversation is not None:
+            resp["conversation_id"] = self.conversation.id
+
+        if self.is_chat:
+            picBase64=""
+            content={
+                "content":answer,
+                "imageBase64":picBase64
+            }
+            # just gengerate pic in chat mode
+            messages_for_pic = self.messages_for_pic
+            messages_for_pic.append({"role": "assistant", "content": answer })
+            if picgenerate.picture_jobs_enabled:
+                # The picture (if any) is polled later from /v1/images/jobs/<imageJobId>
+                content['imageJobId'] = picgenerate.submit_picture_job(messages_for_pic)
+            else:
+                content['imageBase64'] = picgenerate.create_picture_if_needed(messages_for_pic)
+            resp[self.resp_list][0]["message"] = {"role": "assistant", "content": json.dumps(content)}
+        else:
+            resp[self.resp_list][0]["text"] = answer
+
+        return [json.dumps(resp)]
+
+    def _count_tokens_batch(self, texts):
+        return count_tokens_batch(texts, self.tokenizer)
+
+    # Like len(encode(text)[0]), special tokens included
+    def _count_tokens(self, text):
+        return len(self.tokenizer.encode(str(text)))
+
+    # The older messages closest to the last one, in their original order
+    def _recall(self, query, included_msgs, max_tokens):
+        recalled = sorted(memory.recall(self.memory_index, query, memory.params['top_k'], exclude=included_msgs))
+        texts = [text for _, text in recalled]
+        recalled_msg = ''
+        for text, size in zip(texts, self._count_tokens_batch(texts) if texts else []):
+            if size <= max_tokens:
+                recalled_msg += text
+                max_tokens -= size
+
+        return recalled_msg
+
+    def _remember_reply(self, answer):
+        if self.conversation is None and self.memory_index is None:
+            return
+
+        msg = character_utils.replace_openai_names(f"\nassistant: {answer.strip()}", self.req_params['name1'], self.req_params['name2'])
+        if self.conversation is not None:
+            self.conversation.extend('', [msg], self._count_tokens_batch([msg]), [{"role": "assistant", "content": answer}])
+            sessions.store.save(self.conversation)
+        if self.memory_index is not None:
+            memory.remember(self.memory_index, [msg])
+
+    def __iter__(self):
+        '''
+        Runs the whole request on the calling thread and yields the pieces
+        of the response body.
+        '''
+        try:
+            yield from self.start()
+            for a in self.generator:
+                pieces, stopped = self.feed(a)
+                yield from pieces
+                if stopped:
+                    break
+        finally:
+            self.cancel()
+
+        yield from self.finish()
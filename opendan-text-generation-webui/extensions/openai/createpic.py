@@ -1,14 +1,20 @@
 import base64
+import hashlib
 import io
 import re
 import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
 from pathlib import Path
 
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import yaml
 from PIL import Image
+from threading import BoundedSemaphore, Lock
 
 import os
 import openai,random
@@ -50,16 +56,30 @@ params = {
     'translations': True
 }
 
-characterfocus = ""
-positive_suffix = ""
-negative_suffix = ""
-initial_string = ""
-picture_response = False  # specifies if the next model response should appear as a picture
+# Pictures are made in the background so the text reply doesn't wait for the judge, the prompt and SD
+picture_jobs_enabled = os.getenv('SD_ASYNC_PICTURES', '1').lower() in ['1', 'true', 'yes']
+picture_workers = int(os.getenv('SD_PICTURE_WORKERS', '2'))
+picture_job_ttl = 600  # seconds a finished job is kept for polling
+picture_executor = ThreadPoolExecutor(max_workers=picture_workers, thread_name_prefix='picture')
+picture_jobs = {}
+picture_jobs_lock = Lock()
+
+# One keep-alive connection pool for all the SD requests, and a bound on how many run at once
+sd_max_concurrency = int(os.getenv('SD_MAX_CONCURRENCY', '1'))
+sd_session = requests.Session()
+sd_session.mount('http://', HTTPAdapter(pool_maxsize=max(sd_max_concurrency, picture_workers)))
+sd_session.mount('https://', HTTPAdapter(pool_maxsize=max(sd_max_concurrency, picture_workers)))
+sd_semaphore = BoundedSemaphore(sd_max_concurrency)
+sd_cache_size = int(os.getenv('SD_CACHE_SIZE', '16'))  # pictures kept for fixed seeds
+sd_cache = OrderedDict()
+sd_cache_lock = Lock()
+
+# translations.json and the pose images never change, they are read (and encoded) once at startup
+translations = json.loads(Path('extensions/openai/translations.json').read_text(encoding='utf-8'))
+pose_images = [base64.b64encode(Path(f'extensions/openai/imgs/{i}.png').read_bytes()).decode() for i in range(4)]
 
 def check_need_create_pic(stringList):
-    global initial_string, picture_response
-    initial_string = stringList[-1].get("content")
-    string_evaluation(stringList)
+    picture_response = should_send_image(stringList)
     logging.info(f'need to send image: {picture_response}')
     return picture_response
 
@@ -72,10 +92,52 @@ def get_picture(stringList):
     prompt = prompt.replace('\n', ' ')
     prompt = prompt.replace('in front of a mirror', '')
     prompt = prompt.strip()
-    toggle_generation(False)
-    string = get_sd_pictures(prompt)
+    string = get_sd_pictures(prompt, stringList[-1].get("content"))
     return string
 
+def create_picture_if_needed(stringList):
+    if not check_need_create_pic(stringList):
+        return ""
+    stringList.append(stringList[-1])
+    return get_picture(stringList)
+
+def submit_picture_job(stringList):
+    """
+    Runs the judge, the prompt and the SD stages on the worker pool and
+    returns the id to poll with get_picture_job.
+    """
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    with picture_jobs_lock:
+        for old_id in [k for k, job in picture_jobs.items() if job['status'] != 'pending' and now - job['finished'] > picture_job_ttl]:
+            del picture_jobs[old_id]
+        picture_jobs[job_id] = {'status': 'pending', 'imageBase64': '', 'finished': None}
+
+    picture_executor.submit(_run_picture_job, job_id, list(stringList))
+    return job_id
+
+def _run_picture_job(job_id, stringList):
+    status, image = 'done', ''
+    try:
+        image = create_picture_if_needed(stringList)
+    except Exception as e:
+        logging.info(f"Get exception during picture job: {e}")
+        status = 'error'
+    with picture_jobs_lock:
+        picture_jobs[job_id] = {'status': status, 'imageBase64': image, 'finished': time.time()}
+
+def get_picture_job(job_id):
+    """
+    Returns {"id", "status", "imageBase64"} or None for an unknown (or
+    expired) job. status is 'pending', 'done' or 'error'; a finished job
+    with an empty imageBase64 means that no picture was needed.
+    """
+    with picture_jobs_lock:
+        job = picture_jobs.get(job_id)
+        if job is None:
+            return None
+        return {'id': job_id, 'status': job['status'], 'imageBase64': job['imageBase64']}
+
 def remove_surrounded_chars(string):
     # this expression matches to 'as few symbols as possible (0 upwards) between any asterisks' OR
     # 'as few symbols as possible (0 upwards) between an asterisk and the end of the string'
@@ -89,26 +151,7 @@ def triggers_are_in(string):
     # (?aims) are regex parser flags
     return bool(re.search('(?aims)(send|mail|message|me)\\b.+?\\b(image|img|pic(ture)?|photo|snap(shot)?|selfie|meme)s?\\b', string))
 
-def string_evaluation(stringList):
-    global characterfocus
-    characterfocus = True
-    is_need = need_to_send_image(stringList)
-    logging.info(f'need to send image: {is_need}')
-    if is_need:  # check for trigger words for generation
-        return toggle_generation(True)
-    return toggle_generation(False)
-
-# Add NSFW tags if NSFW is enabled, add character sheet tags if character is describing itself
-def create_suffix():
-    global params, positive_suffix, negative_suffix, characterfocus
-    positive_suffix = ""
-    negative_suffix = ""
-    if characterfocus:
-        positive_suffix = ""
-        negative_suffix = ""
-
-def add_translations(description,triggered_array,tpatterns):
-    global positive_suffix, negative_suffix
+def add_translations(description,triggered_array,tpatterns,positive_suffix,negative_suffix):
     i = 0
     for word_pair in tpatterns['pairs']:
         if triggered_array[i] != 1:
@@ -120,17 +163,17 @@ def add_translations(description,triggered_array,tpatterns):
                 negative_suffix = negative_suffix + ", " + word_pair['SD_negative_translation']
                 triggered_array[i] = 1
         i = i + 1
-    return triggered_array
+    return triggered_array, positive_suffix, negative_suffix
 
 # Get and save the Stable Diffusion-generated picture
-def get_sd_pictures(description):
-    global params, initial_string
-    create_suffix()
+def get_sd_pictures(description, initial_string=""):
+    positive_suffix = ""
+    negative_suffix = ""
     if params['translations']:
-        tpatterns = json.loads(open(Path(f'extensions/openai/translations.json'), 'r', encoding='utf-8').read())
+        tpatterns = translations
         triggered_array = [0] * len(tpatterns['pairs'])
-        triggered_array = add_translations(initial_string,triggered_array,tpatterns)
-        add_translations(description,triggered_array,tpatterns)
+        triggered_array, positive_suffix, negative_suffix = add_translations(initial_string,triggered_array,tpatterns,positive_suffix,negative_suffix)
+        _, positive_suffix, negative_suffix = add_translations(description,triggered_array,tpatterns,positive_suffix,negative_suffix)
 
     payload = {
         "prompt": params['prompt_prefix']  + ", " + description + ", " + positive_suffix,
@@ -163,24 +206,50 @@ def get_sd_pictures(description):
             logging.info('does not use controlnet')
             pass
 
-    num_retries = 3
-    for attempt in range(num_retries):
-        try:
-            response = requests.post(url=f'{params["address"]}/sdapi/v1/txt2img', json=payload)
-            response.raise_for_status()
-            r = response.json()
-            break
-        except Exception as e:
-            logging.info(f"Get exception during generation pic: {e}")
-            if attempt == num_retries - 1:
-                return ""
-        time.sleep(1)
+    r = sd_txt2img(payload)
     visible_result = ""
-    if len(r.get('images')) > 0:
+    if r is not None and len(r.get('images')) > 0:
         img_str = r.get('images')[0]
         visible_result = img_str
     return visible_result
 
+def sd_txt2img(payload):
+    """
+    Posts to the SD API through the shared session, at most
+    SD_MAX_CONCURRENCY requests at a time. When the seed is fixed the same
+    payload always makes the same picture, so those results are cached.
+    """
+    cache_key = None
+    if payload['seed'] != -1 and sd_cache_size > 0:
+        cache_key = hashlib.blake2b(json.dumps(payload, sort_keys=True).encode('utf-8'), digest_size=16).digest()
+        with sd_cache_lock:
+            if cache_key in sd_cache:
+                sd_cache.move_to_end(cache_key)
+                logging.info('use cached picture')
+                return sd_cache[cache_key]
+
+    num_retries = 3
+    r = None
+    with sd_semaphore:
+        for attempt in range(num_retries):
+            try:
+                response = sd_session.post(url=f'{params["address"]}/sdapi/v1/txt2img', json=payload)
+                response.raise_for_status()
+                r = response.json()
+                break
+            except Exception as e:
+                logging.info(f"Get exception during generation pic: {e}")
+                if attempt == num_retries - 1:
+                    return None
+            time.sleep(2 ** attempt)
+
+    if cache_key is not None:
+        with sd_cache_lock:
+            sd_cache[cache_key] = r
+            while len(sd_cache) > sd_cache_size:
+                sd_cache.popitem(last=False)
+    return r
+
 def get_control_net_params(preprocess):
     cnetImage = get_random_img_file()
     if preprocess == 'openpose':
@@ -203,10 +272,9 @@ def get_control_net_params(preprocess):
     return params
 
 def get_random_img_file():
-    random_number = random.randint(0, 3)
+    random_number = random.randint(0, len(pose_images) - 1)
     logging.info(f'random pose: {random_number}')
-    filepath = f'extensions/openai/imgs/{random_number}.png'
-    return load_image_file_as_base64(filepath)
+    return pose_images[random_number]
 
 def load_image_file_as_base64(file):
     img = None
@@ -321,11 +389,72 @@ def need_to_send_image(stringList):
     result_string = ''.join(context)
     messages.append({"role":"user", "content": "The chat record is " + result_string + ". Should an image need to be sent?" })
     response =get_completion_from_messages(messages, temperature=0)
+    if response == "":
+        return None  # the judge couldn't be reached, don't cache that
     if 'True' in response:
         return True
     else:
         return False
 
+# Words without which a picture is never involved, and replies that obviously hand one over.
+# Everything else (requests, refusals, hesitations...) is left to the judge.
+picture_words = re.compile('(?i)\\b(image|img|pic(ture)?|photo|snap(shot)?|selfie|meme|camera)s?\\b')
+picture_given = re.compile("(?i)\\bhere('s| is| are)\\b[^.!?]{0,40}?\\b(image|img|pic(ture)?|photo|snap(shot)?|selfie)s?\\b")
+picture_refused = re.compile("(?i)\\b(sorry|apologi[sz]e|can't|cannot|won't|will not|refuse|no)\\b")
+
+judge_cache_size = 1024
+judge_cache = OrderedDict()
+judge_cache_lock = Lock()  # also guards judge_stats
+judge_stats = {'local': 0, 'cached': 0, 'remote': 0}
+
+def local_judgement(stringList):
+    """
+    True or False when the last exchange is clear enough to decide
+    without the remote judge, None otherwise.
+    """
+    user = ' '.join(remove_surrounded_chars(m.get('content')) for m in stringList[-2:] if m.get('role') == 'user')
+    reply = ' '.join(m.get('content') for m in stringList[-2:] if m.get('role') == 'assistant')
+    if not picture_words.search(user) and not picture_words.search(reply):
+        return False
+    if picture_given.search(reply) and not picture_refused.search(reply):
+        return True
+    return None
+
+def judge_cache_key(stringList):
+    h = hashlib.blake2b(digest_size=16)
+    for m in stringList[-2:]:
+        h.update(f"{m.get('role')}\0{m.get('content')}\0".encode('utf-8'))
+    return h.digest()
+
+def should_send_image(stringList):
+    """
+    Staged version of need_to_send_image: the decision cache first, then
+    the local heuristics, and the remote judge for the ambiguous cases.
+    """
+    key = judge_cache_key(stringList)
+    with judge_cache_lock:
+        if key in judge_cache:
+            judge_cache.move_to_end(key)
+            judge_stats['cached'] += 1
+            return judge_cache[key]
+
+    decision = local_judgement(stringList)
+    stage = 'local' if decision is not None else 'remote'
+    with judge_cache_lock:
+        judge_stats[stage] += 1
+    if decision is None:
+        decision = need_to_send_image(stringList)
+        if decision is None:
+            return False
+
+    with judge_cache_lock:
+        judge_cache[key] = decision
+        if len(judge_cache) > judge_cache_size:
+            judge_cache.popitem(last=False)
+        stats = dict(judge_stats)
+    logging.info(f'judge decisions: {stats}')
+    return decision
+
 def get_sd_prompt(stringList):
     global sys_prompt
     messages=[]
@@ -346,10 +475,3 @@ def get_sd_prompt(stringList):
     messages.append({"role":"user", "content": "The chat record is " + result_string + ". Suggest a prompt for Cherry" })
     response = get_completion_from_messages(messages, temperature=0.1)
     return response
-
-def toggle_generation(*args):
-    global picture_response
-    if not args:
-        picture_response = not picture_response
-    else:
-        picture_response = args[0]
\ No newline at end of file
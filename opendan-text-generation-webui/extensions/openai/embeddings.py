@@ -0,0 +1,126 @@
+'''
+
+Micro-batching for /v1/embeddings.
+
+Every input text gets a future. Texts that were already embedded are
+answered from an LRU cache keyed by model and text hash; the others are
+queued, and a worker thread collects what arrives within a short window
+(OPENEDAI_EMBEDDING_BATCH_WINDOW_MS, default 5) into a single
+SentenceTransformer.encode() call of up to OPENEDAI_EMBEDDING_MAX_BATCH
+texts (default 64). Identical texts that are waiting share a future.
+
+The token count of every text is computed with the embedding model's own
+tokenizer, for the usage field of the response.
+
+'''
+
+import hashlib
+import os
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import Future
+from queue import Empty, Queue
+from threading import Lock, Thread
+
+params = {
+    'batch_window': int(os.environ.get('OPENEDAI_EMBEDDING_BATCH_WINDOW_MS', '5')) / 1000,
+    'max_batch_size': int(os.environ.get('OPENEDAI_EMBEDDING_MAX_BATCH', '64')),
+    'cache_size': int(os.environ.get('OPENEDAI_EMBEDDING_CACHE_SIZE', '4096')),
+}
+
+
+class EmbeddingService:
+    def __init__(self, model, model_name, batch_window=0.005, max_batch_size=64, cache_size=4096):
+        self.model = model
+        self.model_name = model_name
+        self.batch_window = batch_window
+        self.max_batch_size = max(1, max_batch_size)
+        self.cache_size = cache_size
+        self.cache = OrderedDict()  # key -> (embedding, token count)
+        self.pending = {}  # key -> future, for the texts that are queued or being encoded
+        self.lock = Lock()
+        self.queue = Queue()
+        self.thread = Thread(target=self._loop, name='embeddings', daemon=True)
+        self.thread.start()
+
+    def _key(self, text):
+        return (self.model_name, hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=16).digest())
+
+    def submit(self, texts):
+        '''
+        Returns a future per text, resolving to (embedding, token count).
+        '''
+        futures = []
+        with self.lock:
+            for text in texts:
+                key = self._key(text)
+                if key in self.cache:
+                    self.cache.move_to_end(key)
+                    future = Future()
+                    future.set_result(self.cache[key])
+                elif key in self.pending:
+                    future = self.pending[key]
+                else:
+                    future = Future()
+                    self.pending[key] = future
+                    self.queue.put((key, text, future))
+
+                futures.append(future)
+
+        return futures
+
+    def embed(self, texts):
+        return [future.result() for future in self.submit(texts)]
+
+    # Waits for a first text, then takes whatever else arrives within the window
+    def _collect(self):
+        batch = [self.queue.get()]
+        deadline = time.perf_counter() + self.batch_window
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                batch.append(self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait())
+            except Empty:
+                break
+
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            texts = [text for _, text, _ in batch]
+            try:
+                embeddings = self.model.encode(texts, batch_size=len(texts))
+                token_counts = [len(ids) for ids in self.model.tokenizer(texts)['input_ids']]
+            except Exception as e:
+                traceback.print_exc()
+                with self.lock:
+                    for key, _, future in batch:
+                        self.pending.pop(key, None)
+                        future.set_exception(e)
+
+                continue
+
+            with self.lock:
+                for (key, _, future), embedding, token_count in zip(batch, embeddings, token_counts):
+                    # Longer texts are truncated by the model
+                    result = (embedding, min(token_count, self.model.max_seq_length))
+                    self.pending.pop(key, None)
+                    if self.cache_size > 0:
+                        self.cache[key] = result
+                        while len(self.cache) > self.cache_size:
+                            self.cache.popitem(last=False)
+
+                    future.set_result(result)
+
+
+service = None
+
+
+def start(model, model_name):
+    global service
+    if service is None:
+        service = EmbeddingService(model, model_name, params['batch_window'], params['max_batch_size'], params['cache_size'])
+
+    return service
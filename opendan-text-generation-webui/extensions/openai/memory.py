@@ -0,0 +1,361 @@
+'''
+
+Long-term memory for /chat/completions (OPENEDAI_MEMORY=1).
+
+The prompt only has room for the most recent messages. Every message of a
+conversation (identified by the conversation_id or user field of the
+request) is also embedded with the embedding model and added to a vector
+index of that conversation. When older messages had to be left out of the
+prompt, the ones most similar to the new message are recalled and put
+back in, before the recent ones, within OPENEDAI_MEMORY_TOKENS tokens.
+The messages go through the embeddings micro-batcher, and are added to
+the index when their embeddings are ready: the request doesn't wait for
+them, only for the embedding of the query when there is a recall.
+
+The search is a cosine similarity over the normalized vectors, a single
+matrix-vector product. From OPENEDAI_MEMORY_IVF_MIN vectors on, a coarse
+IVF index (spherical k-means, trained in the background) restricts it to
+the vectors of the clusters closest to the query.
+
+An index keeps the OPENEDAI_MEMORY_MAX_VECTORS most recent messages: past
+that, the oldest quarter of them is dropped.
+
+With OPENEDAI_MEMORY_DIR set, the indexes are appended to files there
+(raw float32 vectors and a jsonl of the texts) and survive restarts; only
+the OPENEDAI_MEMORY_MAX_LOADED most recently used ones stay in memory.
+
+'''
+
+import hashlib
+import json
+import os
+import traceback
+from collections import OrderedDict
+from threading import Lock, Thread
+
+import numpy as np
+
+import extensions.openai.embeddings as embeddings
+
+params = {
+    'enabled': os.environ.get('OPENEDAI_MEMORY', '0').lower() in ['1', 'true', 'yes'],
+    'top_k': int(os.environ.get('OPENEDAI_MEMORY_TOP_K', '4')),
+    'max_tokens': int(os.environ.get('OPENEDAI_MEMORY_TOKENS', '256')),
+    'ivf_min': int(os.environ.get('OPENEDAI_MEMORY_IVF_MIN', '20000')),
+    'nprobe': int(os.environ.get('OPENEDAI_MEMORY_NPROBE', '8')),
+    'max_loaded': int(os.environ.get('OPENEDAI_MEMORY_MAX_LOADED', '16')),
+    'max_vectors': int(os.environ.get('OPENEDAI_MEMORY_MAX_VECTORS', '50000')),
+    'dir': os.environ.get('OPENEDAI_MEMORY_DIR'),
+}
+
+
+def text_hash(text):
+    return hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=16).hexdigest()
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+# Spherical k-means on a sample of the vectors, returns the centroids
+def _train_centroids(vectors, nlist, iterations=8):
+    rng = np.random.default_rng(0)
+    sample = vectors[rng.choice(len(vectors), min(len(vectors), nlist * 32), replace=False)]
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)]
+    for _ in range(iterations):
+        assignments = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12), centroids)
+
+    return centroids
+
+
+class _IVF:
+    def __init__(self, centroids):
+        self.centroids = centroids
+        self.assignments = np.empty(0, dtype=np.int32)
+
+    def assign(self, vectors, chunk_size=8192):
+        parts = [np.argmax(vectors[i:i + chunk_size] @ self.centroids.T, axis=1).astype(np.int32) for i in range(0, len(vectors), chunk_size)]
+        self.assignments = np.concatenate([self.assignments] + parts)
+
+    # The rows (among the first n) that belong to the nprobe clusters closest to the query
+    def candidates(self, query, nprobe, n):
+        nprobe = min(nprobe, len(self.centroids))
+        lists = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        return np.flatnonzero(np.isin(self.assignments[:n], lists))
+
+
+class VectorIndex:
+    def __init__(self, dim, path=None):
+        self.dim = dim
+        self.path = path
+        self.vectors = np.zeros((1024, dim), dtype=np.float32)
+        self.size = 0
+        self.texts = []
+        self.rows = {}  # text hash -> row
+        self.ivf = None
+        self.ivf_size = 0  # number of vectors the IVF was trained on
+        self.training = False
+        self.dropped = 0  # number of rows dropped from the start so far
+        self.lock = Lock()
+        self.file_lock = Lock()  # held by add(), so that the files get the rows in their order
+
+    def __contains__(self, text):
+        return text_hash(text) in self.rows
+
+    def add(self, vectors, texts, save=True):
+        vectors = _normalize(vectors)
+        with self.file_lock:
+            with self.lock:
+                # Texts that were added since the caller looked
+                new = {}
+                for i, text in enumerate(texts):
+                    key = text_hash(text)
+                    if key not in self.rows:
+                        new.setdefault(key, i)
+
+                if len(new) == 0:
+                    return
+
+                vectors = vectors[list(new.values())]
+                texts = [texts[i] for i in new.values()]
+                if self.size + len(vectors) > len(self.vectors):
+                    grown = np.zeros((max(2 * len(self.vectors), self.size + len(vectors)), self.dim), dtype=np.float32)
+                    grown[:self.size] = self.vectors[:self.size]
+                    self.vectors = grown
+
+                self.vectors[self.size:self.size + len(vectors)] = vectors
+                for i, text in enumerate(texts):
+                    self.rows[text_hash(text)] = self.size + i
+
+                self.texts += texts
+                self.size += len(vectors)
+                if self.ivf is not None:
+                    self.ivf.assign(vectors)
+
+                dropped = self.size > params['max_vectors']
+                if dropped:
+                    self._drop_oldest(self.size - params['max_vectors'] * 3 // 4)
+                    kept_vectors, kept_texts = self.vectors[:self.size], self.texts
+
+                retrain = self.size >= params['ivf_min'] and self.size >= 2 * self.ivf_size and not self.training
+                if retrain:
+                    self.training = True
+
+            if save and self.path is not None:
+                if dropped:
+                    self._write_files(kept_vectors, kept_texts)
+                else:
+                    self._append_files(vectors, texts)
+
+        if retrain:
+            Thread(target=self._train, daemon=True).start()
+
+    # New arrays and lists, the searches that are running keep reading the old ones
+    def _drop_oldest(self, n):
+        vectors = np.zeros((max(1024, 2 * (self.size - n)), self.dim), dtype=np.float32)
+        vectors[:self.size - n] = self.vectors[n:self.size]
+        self.vectors = vectors
+        self.texts = self.texts[n:]
+        self.rows = {text_hash(text): row for row, text in enumerate(self.texts)}
+        self.size -= n
+        self.dropped += n
+        if self.ivf is not None:
+            ivf = _IVF(self.ivf.centroids)
+            ivf.assignments = self.ivf.assignments[n:]
+            self.ivf = ivf
+
+    def _train(self):
+        try:
+            with self.lock:
+                vectors = self.vectors
+                n = self.size
+                dropped = self.dropped
+
+            ivf = _IVF(_train_centroids(vectors[:n], int(np.sqrt(n))))
+            ivf.assign(vectors[:n])
+            with self.lock:
+                if self.dropped == dropped:
+                    # Vectors added in the meantime
+                    ivf.assign(self.vectors[n:self.size])
+                    self.ivf = ivf
+                    self.ivf_size = n
+        except Exception:
+            traceback.print_exc()
+        finally:
+            self.training = False
+
+    def search(self, query, k, exclude=()):
+        '''
+        Returns the rows and texts of the k stored texts closest to the
+        query vector, leaving out the texts whose hash is in exclude.
+        '''
+        query = _normalize(query)
+        with self.lock:
+            vectors = self.vectors
+            texts = self.texts
+            n = self.size
+            ivf = self.ivf
+
+        if n == 0:
+            return []
+
+        if ivf is not None:
+            rows = ivf.candidates(query, params['nprobe'], n)
+            scores = vectors[rows] @ query
+        else:
+            rows = None
+            scores = vectors[:n] @ query
+
+        # A few more than k, some of them may be excluded
+        m = min(len(scores), k + len(exclude))
+        if m == 0:
+            return []
+
+        top = np.argpartition(-scores, m - 1)[:m]
+        top = top[np.argsort(-scores[top])]
+        if rows is not None:
+            top = rows[top]
+
+        results = []
+        for row in top:
+            text = texts[row]
+            if text_hash(text) not in exclude:
+                results.append((int(row), text))
+                if len(results) == k:
+                    break
+
+        return results
+
+    def _append_files(self, vectors, texts):
+        try:
+            with open(self.path + '.f32', 'ab') as f:
+                f.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+            with open(self.path + '.jsonl', 'a') as f:
+                for text in texts:
+                    f.write(json.dumps(text) + '\n')
+        except OSError:
+            print(f'failed to save the memory to {self.path}')
+
+    def _write_files(self, vectors, texts):
+        try:
+            with open(self.path + '.f32.tmp', 'wb') as f:
+                f.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+            with open(self.path + '.jsonl.tmp', 'w') as f:
+                f.writelines(json.dumps(text) + '\n' for text in texts)
+
+            # Texts first: after a crash in between, load() cuts the longer file back
+            os.replace(self.path + '.jsonl.tmp', self.path + '.jsonl')
+            os.replace(self.path + '.f32.tmp', self.path + '.f32')
+        except OSError:
+            print(f'failed to save the memory to {self.path}')
+
+    @classmethod
+    def load(cls, path, dim):
+        try:
+            with open(path + '.jsonl') as f:
+                texts = [json.loads(line) for line in f if line.endswith('\n')]
+            vectors = np.fromfile(path + '.f32', dtype=np.float32)
+        except (OSError, ValueError):
+            return None
+
+        # An interrupted write leaves the two files out of step, cut them back to what they have in common
+        n = min(len(texts), len(vectors) // dim)
+        if n < len(texts) or n * dim < len(vectors):
+            os.truncate(path + '.f32', n * dim * 4)
+            with open(path + '.jsonl', 'w') as f:
+                f.writelines(json.dumps(text) + '\n' for text in texts[:n])
+
+        # Only the most recent ones, like add() keeps them
+        start = max(0, n - params['max_vectors'])
+        index = cls(dim, path)
+        if n > start:
+            index.add(vectors[start * dim:n * dim].reshape(n - start, dim), texts[start:n], save=False)
+
+        return index
+
+
+class MemoryStore:
+    def __init__(self, max_loaded=16, disk_dir=None):
+        self.max_loaded = max_loaded
+        self.disk_dir = disk_dir
+        self.indexes = OrderedDict()
+        self.lock = Lock()
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    # The dimension is part of the name, the files of another embedding model are left alone
+    def _path(self, key, dim):
+        return os.path.join(self.disk_dir, f'{text_hash(key)}-{dim}') if self.disk_dir else None
+
+    def get(self, key, dim):
+        with self.lock:
+            index = self.indexes.get(key)
+            if index is not None:
+                self.indexes.move_to_end(key)
+                return index
+
+        path = self._path(key, dim)
+        index = VectorIndex.load(path, dim) if path is not None else None
+        if index is None:
+            index = VectorIndex(dim, path)
+
+        with self.lock:
+            index = self.indexes.setdefault(key, index)
+            while len(self.indexes) > self.max_loaded:
+                self.indexes.popitem(last=False)
+
+        return index
+
+
+store = MemoryStore(params['max_loaded'], params['dir'])
+
+
+def memory_key(body):
+    key = body.get('conversation_id', body.get('user'))
+    return str(key) if key is not None else None
+
+
+def is_enabled(body):
+    return params['enabled'] and embeddings.service is not None and memory_key(body) is not None
+
+
+def get_index(body):
+    return store.get(memory_key(body), embeddings.service.model.get_sentence_embedding_dimension())
+
+
+# Embeds the texts that aren't in the index yet, and adds them once they are all
+# done, on the embeddings thread: the caller doesn't wait
+def remember(index, texts):
+    new_texts = [text for text in dict.fromkeys(texts) if text not in index]
+    if len(new_texts) == 0:
+        return
+
+    futures = embeddings.service.submit(new_texts)
+    remaining = [len(futures)]
+    lock = Lock()
+
+    def done(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0] > 0:
+                return
+
+        try:
+            index.add([future.result()[0] for future in futures], new_texts)
+        except Exception:
+            traceback.print_exc()
+
+    for future in futures:
+        future.add_done_callback(done)
+
+
+# The query is usually the last message, already submitted by remember(): it shares its future
+def recall(index, query, k, exclude):
+    query_vector = embeddings.service.embed([query])[0][0]
+    return index.search(query_vector, k, exclude=set(text_hash(text) for text in exclude))
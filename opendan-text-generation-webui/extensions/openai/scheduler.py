@@ -0,0 +1,521 @@
+'''
+
+Continuous batching for the OpenAI compatible API.
+
+Every request is put on a central queue and a single worker thread owns the
+model. Active sequences are kept in one left-padded batch that is advanced
+by one token per forward pass; new requests are prefilled and join the batch
+at step boundaries, finished ones leave it.
+
+Backends that can't be batched this way (llama.cpp, RWKV, FlexGen, seq2seq,
+soft prompts, custom_generate_reply extensions...) are still served by the
+same worker, one request at a time, through generate_reply.
+
+Requests are routed by model (see modules/model_registry.py). Each model
+has its own queue and batch, and the worker gives every model with work a
+step in turn, swapping it in first. A model that isn't loaded yet only gets
+its turn once the current one has no work left or has had model_slice
+seconds: it may have to be unloaded to make room.
+
+'''
+
+import asyncio
+import inspect
+import random
+import time
+import traceback
+from collections import OrderedDict, deque
+from queue import Empty, Queue
+from threading import Thread
+
+import torch
+import torch.nn.functional as F
+import transformers
+
+import modules.prefix_cache as prefix_cache
+from modules import metrics, shared
+from modules.extensions import apply_extensions
+from modules.model_registry import registry
+from modules.prefix_cache import (get_past_key_values, is_enabled,
+                                  model_supports_cache_reuse)
+from modules.stop_matcher import TextStopMatcher
+from modules.text_generation import (IncrementalDetokenizer, encode,
+                                     generate_reply, get_max_prompt_length,
+                                     get_reply_from_output_ids)
+
+
+class GenerationRequest:
+
+    """
+    Handle returned to the HTTP handler. Iterating over it yields the
+    cumulative reply, like generate_reply does.
+
+    When created with an asyncio loop, the worker hands the replies over
+    to an asyncio.Queue on that loop instead, and the handle is consumed
+    with async for.
+    """
+
+    def __init__(self, prompt, state, stopping_strings, loop=None, keep_cache=False, model=None):
+        self.prompt = prompt
+        self.model = model
+        self.state = state
+        self.stopping_strings = [s for s in stopping_strings if s]
+        self.loop = loop
+        self.keep_cache = keep_cache
+        self.q = Queue() if loop is None else asyncio.Queue()
+        self.sentinel = object()
+        self.cancelled = False
+        self.reply = ''
+        self.finish_reason = None
+        self.prompt_tokens = None
+        self.completion_tokens = None
+        self.metrics = metrics.RequestMetrics()
+
+    def cancel(self):
+        self.cancelled = True
+
+    def _send(self, obj):
+        if self.loop is None:
+            self.q.put(obj)
+        else:
+            self.loop.call_soon_threadsafe(self.q.put_nowait, obj)
+
+    def put(self, reply):
+        self.reply = reply
+        self._send(reply)
+
+    def finish(self, finish_reason):
+        self.finish_reason = finish_reason
+        self.metrics.finish(finish_reason)
+        self._send(self.sentinel)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        obj = self.q.get(True, None)
+        if obj is self.sentinel:
+            raise StopIteration
+        else:
+            return obj
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        obj = await self.q.get()
+        if obj is self.sentinel:
+            raise StopAsyncIteration
+        else:
+            return obj
+
+
+class _Sequence:
+    def __init__(self, request, state, question, input_ids, eos_token_ids):
+        self.request = request
+        self.state = state
+        self.question = question
+        self.input_ids = input_ids
+        self.ids = input_ids[0]
+        self.eos_token_ids = eos_token_ids
+        self.processors = _build_logits_processors(state, input_ids, eos_token_ids)
+        self.stop_matcher = TextStopMatcher(request.stopping_strings)
+        self.detokenizer = IncrementalDetokenizer(state['skip_special_tokens'])
+        self.seed = int(state['seed']) if int(state['seed']) != -1 else random.randint(1, 2**31)
+        self.generator = None
+        self.new_tokens = 0
+        self.finished = False
+        self.t0 = time.time()
+
+    def sample(self, logits):
+        scores = self.processors(self.ids.unsqueeze(0), logits.float())
+        if not self.state['do_sample']:
+            return torch.argmax(scores, dim=-1)
+
+        if self.generator is None:
+            self.generator = torch.Generator(device=scores.device)
+            self.generator.manual_seed(self.seed)
+
+        probs = torch.softmax(scores, dim=-1)
+        return torch.multinomial(probs, num_samples=1, generator=self.generator)[0]
+
+
+def _build_logits_processors(state, input_ids, eos_token_ids):
+    processors = transformers.LogitsProcessorList()
+    if state['repetition_penalty'] != 1.0:
+        processors.append(transformers.RepetitionPenaltyLogitsProcessor(penalty=state['repetition_penalty']))
+    if state['encoder_repetition_penalty'] != 1.0:
+        processors.append(transformers.EncoderRepetitionPenaltyLogitsProcessor(penalty=state['encoder_repetition_penalty'], encoder_input_ids=input_ids))
+    if state['no_repeat_ngram_size'] > 0:
+        processors.append(transformers.NoRepeatNGramLogitsProcessor(state['no_repeat_ngram_size']))
+    if state['min_length'] > 0 and len(eos_token_ids) > 0:
+        processors.append(transformers.MinLengthLogitsProcessor(state['min_length'], eos_token_ids))
+    if state['ban_eos_token'] and shared.tokenizer.eos_token_id is not None:
+        processors.append(transformers.SuppressTokensLogitsProcessor([shared.tokenizer.eos_token_id]))
+
+    if state['do_sample']:
+        if state['temperature'] != 1.0:
+            processors.append(transformers.TemperatureLogitsWarper(state['temperature']))
+        if state['top_k'] > 0:
+            processors.append(transformers.TopKLogitsWarper(top_k=state['top_k']))
+        if state['top_p'] < 1.0:
+            processors.append(transformers.TopPLogitsWarper(top_p=state['top_p']))
+        if state['typical_p'] < 1.0:
+            processors.append(transformers.TypicalLogitsWarper(mass=state['typical_p']))
+
+    return processors
+
+
+# Pads the sequence dimension of a past_key_values tensor or an attention mask on the left
+def _left_pad(tensor, length, dim):
+    missing = length - tensor.shape[dim]
+    if missing == 0:
+        return tensor
+
+    pad = [0, 0] * (tensor.dim() - dim % tensor.dim() - 1) + [missing, 0]
+    return F.pad(tensor, pad)
+
+
+# Architectures that take the positions from the attention mask by themselves (no position_ids argument)
+mask_position_model_types = ['opt']
+
+
+def takes_position_ids(model):
+    return 'position_ids' in inspect.signature(model.forward).parameters
+
+
+# The rows of a batch are left-padded, their positions have to be counted from the attention mask
+def supports_padding(model):
+    return takes_position_ids(model) or getattr(model.config, 'model_type', None) in mask_position_model_types
+
+
+def _model_inputs(input_ids, past_key_values, attention_mask):
+    model_inputs = shared.model.prepare_inputs_for_generation(input_ids, past_key_values=past_key_values, attention_mask=attention_mask, use_cache=True)
+
+    # Not every prepare_inputs_for_generation does this (gpt_neox, gptj... in transformers 4.28)
+    if takes_position_ids(shared.model):
+        position_ids = attention_mask.long().cumsum(-1) - 1
+        position_ids.masked_fill_(attention_mask == 0, 1)
+        model_inputs['position_ids'] = position_ids[:, -model_inputs['input_ids'].shape[1]:]
+
+    return model_inputs
+
+
+def supports_batching(state):
+    if not model_supports_cache_reuse() or not supports_padding(shared.model):
+        return False
+    if apply_extensions('custom_generate_reply') is not None:
+        return False
+
+    return state['num_beams'] == 1 and state['penalty_alpha'] == 0
+
+
+class _ModelBatch:
+
+    """
+    The requests of one model: waiting to start, in its running batch, or
+    served through generate_reply when they can't be batched.
+    """
+
+    def __init__(self, model_name):
+        self.model_name = model_name
+        self.pending = deque()
+        self.active = []
+        self.past_key_values = None
+        self.attention_mask = None
+        self.serial = None  # (request, replies)
+
+    def idle(self):
+        return len(self.pending) == 0 and len(self.active) == 0 and self.serial is None
+
+    def reset(self):
+        self.active = []
+        self.past_key_values = None
+        self.attention_mask = None
+
+
+class BatchScheduler:
+    def __init__(self, max_batch_size=8, model_slice=10):
+        self.max_batch_size = max(1, max_batch_size)
+        self.model_slice = model_slice
+        self.loaded_at = time.time()  # when the current model was loaded
+        self.queue = Queue()
+        self.batches = OrderedDict()  # model name -> _ModelBatch, served in turn
+        self.thread = Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, prompt, state, stopping_strings=[], loop=None, keep_cache=False, model=None):
+        request = GenerationRequest(prompt, state, stopping_strings, loop=loop, keep_cache=keep_cache, model=registry.resolve(model))
+        self.queue.put(request)
+        return request
+
+    # Every model with work gets a decode step in turn, so a slow model doesn't hold up the others
+    def _loop(self):
+        while True:
+            self._route()
+            for batch in list(self.batches.values()):
+                if not self._can_serve(batch):
+                    continue
+
+                try:
+                    if not registry.is_loaded(batch.model_name):
+                        self.loaded_at = time.time()
+
+                    registry.use(batch.model_name)
+                except Exception:
+                    # The model can't be loaded, none of its requests can be served
+                    traceback.print_exc()
+                    self._fail(batch, pending=True)
+                    del self.batches[batch.model_name]
+                    continue
+
+                try:
+                    self._admit(batch)
+                    if batch.serial is not None:
+                        self._step_serial(batch)
+                    if len(batch.active) > 0:
+                        with torch.no_grad():
+                            self._step(batch)
+                except Exception:
+                    traceback.print_exc()
+                    self._fail(batch)
+
+                if batch.idle():
+                    del self.batches[batch.model_name]
+
+    # Loading a model can unload the current one, which would then be loaded again for its next step
+    def _can_serve(self, batch):
+        if registry.is_loaded(batch.model_name):
+            return True
+
+        current = self.batches.get(shared.model_name)
+        return current is None or current.idle() or time.time() - self.loaded_at >= self.model_slice
+
+    # Sorts the new requests by model, waits for one when there is nothing else to do
+    def _route(self):
+        block = len(self.batches) == 0
+        while True:
+            try:
+                request = self.queue.get(block=block)
+            except Empty:
+                return
+
+            block = False
+            if request.cancelled:
+                request.finish('cancelled')
+                continue
+
+            if request.model not in self.batches:
+                self.batches[request.model] = _ModelBatch(request.model)
+
+            self.batches[request.model].pending.append(request)
+
+    # New requests only join between two decode steps
+    def _admit(self, batch):
+        waiting = deque()
+        while len(batch.pending) > 0:
+            request = batch.pending.popleft()
+            if request.cancelled:
+                request.finish('cancelled')
+            elif not supports_batching(request.state):
+                if batch.serial is None:
+                    self._start_serial(batch, request)
+                else:
+                    waiting.append(request)
+            elif len(batch.active) < self.max_batch_size:
+                try:
+                    with torch.no_grad():
+                        batched = self._prefill(batch, request)
+                except Exception:
+                    traceback.print_exc()
+                    request.finish('error')
+                    continue
+
+                if not batched:
+                    waiting.append(request)
+            else:
+                waiting.append(request)
+
+        batch.pending = waiting
+
+    def _start_serial(self, batch, request):
+        batch.serial = (request, generate_reply(request.prompt, request.state, stopping_strings=request.stopping_strings))
+
+    # Advances a request that isn't batched by one reply
+    def _step_serial(self, batch):
+        request, replies = batch.serial
+        # generate_reply picks these up to record its timings
+        metrics.set_current(request.metrics)
+        try:
+            reply = None if request.cancelled else next(replies)
+        except StopIteration:
+            reply = None
+        finally:
+            metrics.set_current(None)
+
+        if reply is None:
+            replies.close()
+            batch.serial = None
+            request.finish('cancelled' if request.cancelled else 'stop')
+        else:
+            request.put(reply)
+
+    # Returns False when the request has to go through generate_reply instead
+    def _prefill(self, batch, request):
+        state = apply_extensions('state', request.state)
+        question = request.prompt
+        if not shared.is_chat():
+            question = apply_extensions('input', question)
+
+        t_encode = time.perf_counter()
+        input_ids = encode(question, add_bos_token=state['add_bos_token'], truncation_length=get_max_prompt_length(state))
+        question, input_ids, inputs_embeds = apply_extensions('tokenizer', state, question, input_ids, None)
+        if inputs_embeds is not None:
+            if batch.serial is None:
+                self._start_serial(batch, request)
+                return True
+
+            return False
+
+        request.metrics.backend = 'transformers'
+        request.metrics.started()
+        request.metrics.observe_tokenization(time.perf_counter() - t_encode)
+
+        request.prompt_tokens = len(input_ids[0])
+        request.completion_tokens = 0
+        eos_token_ids = [shared.tokenizer.eos_token_id] if shared.tokenizer.eos_token_id is not None else []
+        seq = _Sequence(request, state, request.prompt, input_ids, eos_token_ids)
+
+        t_prefill = time.perf_counter()
+        attention_mask = torch.ones_like(input_ids)
+        past_key_values = get_past_key_values(input_ids) if is_enabled() else None
+        outputs = shared.model(**_model_inputs(input_ids, past_key_values, attention_mask), return_dict=True)
+        token = seq.sample(outputs.logits[:, -1, :])
+        int(token)  # waits for the forward pass to be done
+        request.metrics.observe_prefill(time.perf_counter() - t_prefill)
+
+        self._join(batch, outputs.past_key_values, attention_mask)
+        batch.active.append(seq)
+        self._append_token(batch, seq, token)
+        self._evict_finished(batch)
+        return True
+
+    # Merges the cache of a freshly prefilled sequence into the running batch
+    def _join(self, batch, past_key_values, attention_mask):
+        if batch.past_key_values is None:
+            batch.past_key_values = past_key_values
+            batch.attention_mask = attention_mask
+            return
+
+        length = max(batch.attention_mask.shape[1], attention_mask.shape[1])
+        batch.attention_mask = torch.cat((_left_pad(batch.attention_mask, length, 1), _left_pad(attention_mask, length, 1)), dim=0)
+        batch.past_key_values = tuple(
+            tuple(torch.cat((_left_pad(a, length, -2), _left_pad(b, length, -2)), dim=0) for a, b in zip(layer_a, layer_b))
+            for layer_a, layer_b in zip(batch.past_key_values, past_key_values)
+        )
+
+    def _step(self, batch):
+        input_ids = torch.stack([seq.ids[-1:] for seq in batch.active])
+        batch.attention_mask = torch.cat((batch.attention_mask, batch.attention_mask.new_ones((len(batch.active), 1))), dim=1)
+        outputs = shared.model(**_model_inputs(input_ids, batch.past_key_values, batch.attention_mask), return_dict=True)
+        batch.past_key_values = outputs.past_key_values
+
+        logits = outputs.logits[:, -1, :]
+        for i, seq in enumerate(batch.active):
+            self._append_token(batch, seq, seq.sample(logits[i:i + 1]))
+
+        self._evict_finished(batch)
+
+    def _append_token(self, batch, seq, token):
+        request = seq.request
+        seq.ids = torch.cat((seq.ids, token.view(1).to(seq.ids.device)))
+        seq.new_tokens += 1
+
+        finish_reason = None
+        if int(token) in seq.eos_token_ids:
+            finish_reason = 'stop'
+        else:
+            request.completion_tokens += 1
+            request.metrics.add_tokens()
+            if seq.new_tokens >= seq.state['max_new_tokens']:
+                finish_reason = 'length'
+            elif request.cancelled:
+                finish_reason = 'cancelled'
+
+        reply = get_reply_from_output_ids(seq.ids, seq.input_ids, seq.question, seq.state, detokenizer=seq.detokenizer)
+        if finish_reason is None and seq.stop_matcher.update(reply)[0] is not None:
+            finish_reason = 'stop'
+
+        if seq.state['stream'] or finish_reason is not None:
+            request.put(reply)
+        else:
+            request.reply = reply
+
+        if finish_reason is not None:
+            if request.keep_cache and finish_reason != 'cancelled' and is_enabled():
+                self._store_cache(batch, seq)
+
+            self._finish(batch, seq, finish_reason)
+
+    # The next turn of a conversation starts with this prompt and reply, so their keys and values are kept
+    def _store_cache(self, batch, seq):
+        i = batch.active.index(seq)
+        length = len(seq.ids) - 1  # the last token hasn't been through the model
+        start = batch.attention_mask.shape[1] - length
+        past_key_values = tuple(tuple(t[i:i + 1].narrow(-2, start, length).clone() for t in layer) for layer in batch.past_key_values)
+        prefix_cache.prefix_cache.store(seq.ids[:length].cpu().numpy(), past_key_values)
+
+    def _finish(self, batch, seq, finish_reason):
+        seq.finished = True
+        seq.request.finish(finish_reason)
+        t1 = time.time()
+        print(f'Output generated in {(t1-seq.t0):.2f} seconds ({seq.new_tokens/(t1-seq.t0):.2f} tokens/s, {seq.new_tokens} tokens, context {len(seq.input_ids[0])}, seed {seq.seed}, batch {len(batch.active)}, model {batch.model_name})')
+
+    def _fail(self, batch, pending=False):
+        if pending:
+            while len(batch.pending) > 0:
+                batch.pending.popleft().finish('error')
+
+        for seq in batch.active:
+            if not seq.finished:
+                self._finish(batch, seq, 'error')
+
+        batch.reset()
+        if batch.serial is not None:
+            batch.serial[0].finish('error')
+            batch.serial = None
+
+    def _evict_finished(self, batch):
+        keep = [i for i, seq in enumerate(batch.active) if not seq.finished]
+        if len(keep) == len(batch.active):
+            return
+        elif len(keep) == 0:
+            batch.reset()
+            return
+
+        index = torch.tensor(keep, device=batch.attention_mask.device)
+        batch.active = [batch.active[i] for i in keep]
+        batch.attention_mask = batch.attention_mask.index_select(0, index)
+        batch.past_key_values = tuple(tuple(t.index_select(0, index.to(t.device)) for t in layer) for layer in batch.past_key_values)
+
+        # Drop the leading columns that are now padding for every remaining sequence
+        start = int(batch.attention_mask.any(dim=0).nonzero()[0])
+        if start > 0:
+            length = batch.attention_mask.shape[1] - start
+            batch.attention_mask = batch.attention_mask[:, start:]
+            batch.past_key_values = tuple(tuple(t.narrow(-2, start, length) for t in layer) for layer in batch.past_key_values)
+
+
+scheduler = None
+
+
+def start(max_batch_size=8, model_slice=10):
+    global scheduler
+    if scheduler is None:
+        scheduler = BatchScheduler(max_batch_size, model_slice)
+
+    return scheduler
+
+
+def generate(prompt, state, stopping_strings=[], loop=None, keep_cache=False, model=None):
+    return start().submit(prompt, state, stopping_strings, loop=loop, keep_cache=keep_cache, model=model)
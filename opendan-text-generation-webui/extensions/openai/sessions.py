@@ -0,0 +1,209 @@
+'''
+
+Server side conversations for /chat/completions.
+
+A client that sends a conversation_id only has to send the new messages:
+the history is kept here along with the token count of every message, so
+it is neither sent nor tokenized again, and the reply is appended when the
+generation ends. The prompt of the next turn starts like the previous one,
+so the prefix cache finds its keys and values.
+
+Conversations are kept in memory up to OPENEDAI_SESSION_MEMORY_MB (LRU) and
+expire after OPENEDAI_SESSION_TTL seconds without a request. If
+OPENEDAI_SESSION_DIR is set, the ones evicted from memory are written there
+as json, and loaded back when the conversation continues.
+
+'''
+
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from threading import Lock, Thread
+
+from modules import shared
+
+
+class Conversation:
+    def __init__(self, conversation_id, system_msg='', chat_msgs=None, token_counts=None, messages=None, model=None, last_used=None):
+        self.id = conversation_id
+        self.system_msg = system_msg
+        self.chat_msgs = chat_msgs or []  # as they appear in the prompt
+        self.token_counts = token_counts or []
+        self.messages = messages or []  # the original ones, for the pictures
+        self.model = model
+        self.last_used = last_used or time.time()
+        self.lock = Lock()
+
+    def extend(self, system_msg, chat_msgs, token_counts, messages):
+        with self.lock:
+            if system_msg:
+                self.system_msg = system_msg
+
+            self.chat_msgs += chat_msgs
+            self.token_counts += token_counts
+            self.messages += messages
+            self._trim()
+
+    # The stored counts are only valid for the tokenizer they were made with
+    def recount(self, model, count_tokens):
+        with self.lock:
+            self.token_counts = count_tokens(self.chat_msgs) if self.chat_msgs else []
+            self.model = model
+
+    # Messages older than the longest possible prompt will never be used again
+    def _trim(self):
+        total = 0
+        keep = 0
+        for count in reversed(self.token_counts):
+            total += count
+            if total > shared.settings['truncation_length_max']:
+                break
+
+            keep += 1
+
+        drop = len(self.chat_msgs) - keep
+        if drop > 0:
+            del self.chat_msgs[:drop]
+            del self.token_counts[:drop]
+            del self.messages[:drop]
+
+    def snapshot(self):
+        with self.lock:
+            return self.system_msg, list(self.chat_msgs), list(self.token_counts), list(self.messages)
+
+    def nbytes(self):
+        return len(self.system_msg) + sum(2 * len(msg) + 64 for msg in self.chat_msgs)
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'id': self.id,
+                'system_msg': self.system_msg,
+                'chat_msgs': self.chat_msgs,
+                'token_counts': self.token_counts,
+                'messages': self.messages,
+                'model': self.model,
+                'last_used': self.last_used,
+            }
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['id'], d['system_msg'], d['chat_msgs'], d['token_counts'], d['messages'], d['model'], d['last_used'])
+
+
+class ConversationStore:
+    def __init__(self, max_bytes, ttl, disk_dir=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = Lock()
+        self.last_sweep = 0
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    def _path(self, conversation_id):
+        name = hashlib.blake2b(conversation_id.encode('utf-8'), digest_size=16).hexdigest()
+        return os.path.join(self.disk_dir, name + '.json')
+
+    def _expired(self, conversation):
+        return time.time() - conversation.last_used > self.ttl
+
+    def open(self, conversation_id, model):
+        '''
+        Returns the conversation with this id, or a new empty one for model
+        if it doesn't exist or has expired.
+        '''
+        with self.lock:
+            self._expire()
+            entry = self.entries.get(conversation_id)
+
+        conversation = entry[0] if entry is not None else None
+
+        if conversation is None:
+            conversation = self._load(conversation_id)
+        if conversation is None:
+            conversation = Conversation(conversation_id, model=model)
+
+        conversation.last_used = time.time()
+        self.save(conversation)
+        return conversation
+
+    def save(self, conversation):
+        # Called again after every change, to account for the new size
+        spilled = []
+        with self.lock:
+            old = self.entries.pop(conversation.id, None)
+            if old is not None:
+                self.size -= old[1]
+
+            nbytes = conversation.nbytes()
+            self.entries[conversation.id] = (conversation, nbytes)
+            self.size += nbytes
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                evicted, evicted_bytes = self.entries.popitem(last=False)[1]
+                self.size -= evicted_bytes
+                spilled.append(evicted)
+
+        for evicted in spilled:
+            self._spill(evicted)
+
+    # Removes the conversations that expired, the files on disk about once an hour
+    def _expire(self):
+        for conversation_id in [k for k, (conversation, _) in self.entries.items() if self._expired(conversation)]:
+            self.size -= self.entries.pop(conversation_id)[1]
+
+        if self.disk_dir and time.time() - self.last_sweep > 3600:
+            self.last_sweep = time.time()
+            Thread(target=self.remove_expired_files, daemon=True).start()
+
+    def _spill(self, conversation):
+        if not self.disk_dir or self._expired(conversation):
+            return
+
+        try:
+            path = self._path(conversation.id)
+            with open(path + '.tmp', 'w') as f:
+                json.dump(conversation.to_dict(), f)
+
+            os.replace(path + '.tmp', path)
+        except OSError:
+            print(f'failed to write conversation {conversation.id} to {self.disk_dir}')
+
+    def _load(self, conversation_id):
+        if not self.disk_dir:
+            return None
+
+        path = self._path(conversation_id)
+        try:
+            with open(path) as f:
+                conversation = Conversation.from_dict(json.load(f))
+
+            os.remove(path)
+        except (OSError, ValueError, KeyError):
+            return None
+
+        if conversation.id != conversation_id or self._expired(conversation):
+            return None
+
+        return conversation
+
+    def remove_expired_files(self):
+        if not self.disk_dir:
+            return
+
+        for name in os.listdir(self.disk_dir):
+            path = os.path.join(self.disk_dir, name)
+            try:
+                if time.time() - os.path.getmtime(path) > self.ttl:
+                    os.remove(path)
+            except OSError:
+                pass
+
+
+store = ConversationStore(max_bytes=int(os.environ.get('OPENEDAI_SESSION_MEMORY_MB', '64')) * 1024 * 1024,
+                          ttl=int(os.environ.get('OPENEDAI_SESSION_TTL', '86400')),
+                          disk_dir=os.environ.get('OPENEDAI_SESSION_DIR'))
@@ -5,6 +5,8 @@ import torch
 from peft import PeftModel
 
 import modules.shared as shared
+from modules.models import clear_torch_cache
+from modules.prefix_cache import clear_prefix_cache
 
 
 def add_lora_to_model(lora_names):
@@ -17,6 +19,9 @@ def add_lora_to_model(lora_names):
     if len(added_set) == 0 and len(removed_set) == 0:
         return
 
+    # Cached keys and values were computed with the previous set of LoRAs
+    clear_prefix_cache()
+
     # Add a LoRA when another LoRA is already present
     if len(removed_set) == 0 and len(prior_set) > 0:
         logging.info(f"Adding the LoRA(s) named {added_set} to the model...")
@@ -52,3 +57,6 @@ def add_lora_to_model(lora_names):
                     shared.model = shared.model.to(device)
                 else:
                     shared.model = shared.model.cuda()
+
+    # The weights of the previous adapters are garbage now
+    clear_torch_cache(force=True)
@@ -1,49 +1,112 @@
-import gc
 import traceback
-from queue import Queue
-from threading import Thread
+from queue import SimpleQueue
+from threading import Condition, Lock, Thread
 
 import torch
 import transformers
 
 import modules.shared as shared
+from modules.stop_matcher import StopMatcher
 
 
 class _SentinelTokenStoppingCriteria(transformers.StoppingCriteria):
 
     def __init__(self, sentinel_token_ids: list, starting_idx: int):
         transformers.StoppingCriteria.__init__(self)
-        self.sentinel_token_ids = sentinel_token_ids
+        self.sentinel_token_ids = [x.reshape(-1).tolist() for x in sentinel_token_ids]
         self.starting_idx = starting_idx
-        self.shortest = min([x.shape[-1] for x in sentinel_token_ids])
+        self.longest = max(len(x) for x in self.sentinel_token_ids)
+        self.matcher = StopMatcher(self.sentinel_token_ids)
+        self.consumed = starting_idx
 
     def __call__(self, input_ids: torch.LongTensor, _scores: torch.FloatTensor) -> bool:
-        for sample in input_ids:
-            trimmed_sample = sample[self.starting_idx:]
-            trimmed_len = trimmed_sample.shape[-1]
-            if trimmed_len < self.shortest:
-                continue
-
-            for sentinel in self.sentinel_token_ids:
-                sentinel_len = sentinel.shape[-1]
-                if trimmed_len < sentinel_len:
-                    continue
+        # Single sequence: only the tokens generated since the last call are consumed
+        if input_ids.shape[0] == 1:
+            new_tokens = input_ids[0, self.consumed:].tolist()
+            self.consumed = input_ids.shape[-1]
+            return self.matcher.feed(new_tokens) is not None
 
-                window = trimmed_sample[-sentinel_len:]
-                if torch.all(torch.eq(sentinel, window)):
-                    return True
+        # Beams get reordered between steps, so each one is checked from scratch on its last tokens
+        for sample in input_ids:
+            self.matcher.reset()
+            if self.matcher.feed(sample[max(self.starting_idx, sample.shape[-1] - self.longest):].tolist()) is not None:
+                return True
 
         return False
 
 
 class Stream(transformers.StoppingCriteria):
-    def __init__(self, callback_func=None):
+
+    """
+    Calls callback_func with the token ids generated since the previous
+    step (the first sequence only). Generation stops when it returns True.
+    """
+
+    def __init__(self, callback_func=None, starting_idx=0):
         self.callback_func = callback_func
+        self.consumed = starting_idx
 
     def __call__(self, input_ids, scores) -> bool:
-        if self.callback_func is not None:
-            self.callback_func(input_ids[0])
-        return False
+        if self.callback_func is None:
+            return False
+
+        new_ids = input_ids[0, self.consumed:].tolist()
+        self.consumed = input_ids.shape[-1]
+        return bool(self.callback_func(new_ids))
+
+
+class _StopGeneration(Exception):
+    pass
+
+
+# The streamed generations run on worker threads that are reused from one call
+# to the next. Another one is only started when they are all busy, which happens
+# when the API streams from several models at once.
+_tasks = SimpleQueue()
+_idle_workers = 0
+_worker_lock = Lock()
+
+# Number of generations still running on the workers, also the ones whose consumer went away
+_running = 0
+_running_changed = Condition()
+
+
+def wait_for_generations():
+    with _running_changed:
+        _running_changed.wait_for(lambda: _running == 0)
+
+
+def _work():
+    global _idle_workers
+    while True:
+        task = _tasks.get()
+        task()
+        with _worker_lock:
+            _idle_workers += 1
+
+
+def _submit(task):
+    global _idle_workers
+    with _worker_lock:
+        if _idle_workers > 0:
+            _idle_workers -= 1
+        else:
+            Thread(target=_work, name='generation', daemon=True).start()
+
+    _tasks.put(task)
+
+
+def _generation_started():
+    global _running
+    with _running_changed:
+        _running += 1
+
+
+def _generation_done():
+    global _running
+    with _running_changed:
+        _running -= 1
+        _running_changed.notify_all()
 
 
 class Iteratorize:
@@ -52,61 +115,66 @@ class Iteratorize:
     Transforms a function that takes a callback
     into a lazy iterator (generator).
 
+    The function runs on a worker thread that is reused from one call to
+    the next. Once the iteration is over (or the user pressed Stop), the
+    callback returns True so that the function can return on its own;
+    a function that ignores it is interrupted at its next callback.
+
     Adapted from: https://stackoverflow.com/a/9969000
     """
 
     def __init__(self, func, kwargs={}, callback=None):
         self.mfunc = func
         self.c_callback = callback
-        self.q = Queue()
+        self.q = SimpleQueue()
         self.sentinel = object()
         self.kwargs = kwargs
         self.stop_now = False
+        self.stop_sent = False
+        _generation_started()
+        _submit(self._run)
 
-        def _callback(val):
-            if self.stop_now or shared.stop_everything:
-                raise ValueError
-            self.q.put(val)
+    def _callback(self, val):
+        if self.stop_now or shared.stop_everything:
+            if self.stop_sent:
+                raise _StopGeneration
 
-        def gentask():
-            try:
-                ret = self.mfunc(callback=_callback, **self.kwargs)
-            except ValueError:
-                pass
-            except:
-                traceback.print_exc()
-                pass
+            self.stop_sent = True
+            return True
 
-            clear_torch_cache()
-            self.q.put(self.sentinel)
-            if self.c_callback:
-                self.c_callback(ret)
+        self.q.put(val)
+        return False
 
-        self.thread = Thread(target=gentask)
-        self.thread.start()
+    def _run(self):
+        ret = None
+        try:
+            ret = self.mfunc(callback=self._callback, **self.kwargs)
+        except _StopGeneration:
+            pass
+        except:
+            traceback.print_exc()
+            pass
+
+        _generation_done()
+        self.q.put(self.sentinel)
+        if self.c_callback:
+            self.c_callback(ret)
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        obj = self.q.get(True, None)
+        obj = self.q.get()
         if obj is self.sentinel:
             raise StopIteration
         else:
             return obj
 
     def __del__(self):
-        clear_torch_cache()
+        self.stop_now = True
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.stop_now = True
-        clear_torch_cache()
-
-
-def clear_torch_cache():
-    gc.collect()
-    if not shared.args.cpu:
-        torch.cuda.empty_cache()
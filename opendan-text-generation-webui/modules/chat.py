@@ -2,6 +2,7 @@ import ast
 import base64
 import copy
 import io
+import itertools
 import json
 import logging
 import re
@@ -12,9 +13,12 @@ import yaml
 from PIL import Image
 
 import modules.shared as shared
+from modules.chat_log import ChatLog
 from modules.extensions import apply_extensions
-from modules.html_generator import chat_html_wrapper, make_thumbnail
-from modules.text_generation import (encode, generate_reply,
+from modules.html_generator import (chat_html_wrapper, chat_messages_html,
+                                    make_thumbnail)
+from modules.stop_matcher import TextStopMatcher
+from modules.text_generation import (count_tokens, encode, generate_reply,
                                      get_max_prompt_length)
 
 
@@ -26,6 +30,21 @@ def replace_all(text, dic):
     return text
 
 
+# Returns the smallest k in [lo, hi] for which is_done(k) is True, starting
+# the search from a guess. is_done has to be monotonic and is_done(hi) True.
+def _find_boundary(is_done, guess, lo, hi):
+    k = min(max(guess, lo), hi)
+    if is_done(k):
+        while k > lo and is_done(k - 1):
+            k -= 1
+    else:
+        k += 1
+        while not is_done(k):
+            k += 1
+
+    return k
+
+
 def generate_chat_prompt(user_input, state, **kwargs):
     impersonate = kwargs['impersonate'] if 'impersonate' in kwargs else False
     _continue = kwargs['_continue'] if '_continue' in kwargs else False
@@ -61,18 +80,39 @@ def generate_chat_prompt(user_input, state, **kwargs):
     bot_turn_stripped = replace_all(bot_turn.split('<|bot-message|>')[0], replacements)
 
     # Building the prompt
-    i = len(shared.history['internal']) - 1
-    while i >= 0 and len(encode(''.join(rows))[0]) < max_length:
-        if _continue and i == len(shared.history['internal']) - 1:
-            rows.insert(1, bot_turn_stripped + shared.history['internal'][i][1].strip())
+    # Each turn is tokenized once (and memoized across calls) to estimate where the
+    # history has to be cut; the exact cut is then confirmed on the full prompt
+    history = shared.history['internal']
+    n = len(history)
+    turns = []
+
+    def add_next_turn():
+        i = n - 1 - len(turns)
+        turn = []
+        string = history[i][0]
+        if string not in ['', '<|BEGIN-VISIBLE-CHAT|>']:
+            turn.append(replace_all(user_turn, {'<|user-message|>': string.strip(), '<|round|>': str(i)}))
+
+        if _continue and i == n - 1:
+            turn.append(bot_turn_stripped + history[i][1].strip())
         else:
-            rows.insert(1, bot_turn.replace('<|bot-message|>', shared.history['internal'][i][1].strip()))
+            turn.append(bot_turn.replace('<|bot-message|>', history[i][1].strip()))
 
-        string = shared.history['internal'][i][0]
-        if string not in ['', '<|BEGIN-VISIBLE-CHAT|>']:
-            rows.insert(1, replace_all(user_turn, {'<|user-message|>': string.strip(), '<|round|>': str(i)}))
+        turns.append(turn)
+
+    def rows_with_turns(k):
+        while len(turns) < k:
+            add_next_turn()
+
+        return rows[:1] + [row for turn in reversed(turns[:k]) for row in turn]
 
-        i -= 1
+    estimate = count_tokens(rows[0])
+    while len(turns) < n and estimate < max_length:
+        add_next_turn()
+        estimate += sum(count_tokens(row) for row in turns[-1])
+
+    k = _find_boundary(lambda k: k == n or len(encode(''.join(rows_with_turns(k)))[0]) >= max_length, len(turns), 0, n)
+    rows = rows_with_turns(k)
 
     if impersonate:
         min_rows = 2
@@ -85,8 +125,16 @@ def generate_chat_prompt(user_input, state, **kwargs):
         # Adding the Character prefix
         rows.append(apply_extensions("bot_prefix", bot_turn_stripped.rstrip(' ')))
 
-    while len(rows) > min_rows and len(encode(''.join(rows))[0]) >= max_length:
-        rows.pop(1)
+    # Removing the oldest rows until the prompt fits
+    max_pops = max(len(rows) - min_rows, 0)
+    estimate = sum(count_tokens(row) for row in rows)
+    p = 0
+    while p < max_pops and estimate >= max_length:
+        estimate -= count_tokens(rows[1 + p])
+        p += 1
+
+    p = _find_boundary(lambda p: p >= max_pops or len(encode(''.join(rows[:1] + rows[1 + p:]))[0]) < max_length, p, 0, max_pops)
+    rows = rows[:1] + rows[1 + p:]
 
     prompt = ''.join(rows)
     if also_return_rows:
@@ -105,9 +153,8 @@ def get_stopping_strings(state):
     return stopping_strings
 
 
-def extract_message_from_reply(reply, state):
+def extract_message_from_reply(reply, state, stop_matcher=None):
     next_character_found = False
-    stopping_strings = get_stopping_strings(state)
 
     if state['stop_at_newline']:
         lines = reply.split('\n')
@@ -115,24 +162,19 @@ def extract_message_from_reply(reply, state):
         if len(lines) > 1:
             next_character_found = True
     else:
-        for string in stopping_strings:
-            idx = reply.find(string)
-            if idx != -1:
-                reply = reply[:idx]
-                next_character_found = True
+        # Reusing the matcher of the previous call, only the new part of the reply is scanned
+        if stop_matcher is None:
+            stop_matcher = TextStopMatcher(get_stopping_strings(state))
+
+        idx, pending = stop_matcher.update(reply)
+        if idx is not None:
+            reply = reply[:idx]
+            next_character_found = True
 
         # If something like "\nYo" is generated just before "\nYou:"
         # is completed, trim it
-        if not next_character_found:
-            for string in stopping_strings:
-                for j in range(len(string) - 1, 0, -1):
-                    if reply[-j:] == string[:j]:
-                        reply = reply[:-j]
-                        break
-                else:
-                    continue
-
-                break
+        elif pending > 0:
+            reply = reply[:-pending]
 
     return reply, next_character_found
 
@@ -149,6 +191,7 @@ def chatbot_wrapper(text, state, regenerate=False, _continue=False):
     visible_text = None
     eos_token = '\n' if state['stop_at_newline'] else None
     stopping_strings = get_stopping_strings(state)
+    stop_matcher = TextStopMatcher(stopping_strings)
 
     # Preparing the input
     if not any((regenerate, _continue)):
@@ -183,7 +226,7 @@ def chatbot_wrapper(text, state, regenerate=False, _continue=False):
             reply = cumulative_reply + reply
 
             # Extracting the reply
-            reply, next_character_found = extract_message_from_reply(reply, state)
+            reply, next_character_found = extract_message_from_reply(reply, state, stop_matcher)
             visible_reply = re.sub("(<USER>|<user>|{{user}})", state['name1'], reply)
             visible_reply = apply_extensions("output", visible_reply)
             if _continue:
@@ -226,6 +269,7 @@ def impersonate_wrapper(text, state):
     eos_token = '\n' if state['stop_at_newline'] else None
     prompt = generate_chat_prompt(text, state, impersonate=True)
     stopping_strings = get_stopping_strings(state)
+    stop_matcher = TextStopMatcher(stopping_strings)
 
     # Yield *Is typing...*
     yield shared.processing_message
@@ -233,7 +277,7 @@ def impersonate_wrapper(text, state):
         reply = None
         for reply in generate_reply(f"{prompt}{' ' if len(cumulative_reply) > 0 else ''}{cumulative_reply}", state, eos_token=eos_token, stopping_strings=stopping_strings):
             reply = cumulative_reply + reply
-            reply, next_character_found = extract_message_from_reply(reply, state)
+            reply, next_character_found = extract_message_from_reply(reply, state, stop_matcher)
             yield reply
             if next_character_found:
                 break
@@ -244,25 +288,64 @@ def impersonate_wrapper(text, state):
     yield reply
 
 
+stream_ids = itertools.count()
+
+
+def stream_display(histories, state):
+    '''
+    Yields the chat display for every history. With --chat-delta-streaming,
+    only the first one is sent in full: the others are a json of the
+    messages that changed since the previous one, which css/chat.js
+    patches into the page.
+    '''
+    if not shared.args.chat_delta_streaming:
+        for history in histories:
+            yield chat_html_wrapper(history, state['name1'], state['name2'], state['mode'], streaming=True)
+
+        return
+
+    stream = next(stream_ids)
+    sent = None
+    for seq, history in enumerate(histories):
+        messages = chat_messages_html(history, state['name1'], state['name2'], state['mode'], streaming=True)
+        if sent is None:
+            remove, changed = -1, messages
+        else:
+            # The messages are newest first, the old ones at the end are the same
+            same = 0
+            while same < min(len(messages), len(sent)) and messages[-1 - same] == sent[-1 - same]:
+                same += 1
+
+            remove, changed = len(sent) - same, messages[:len(messages) - same]
+
+        sent = messages
+        yield json.dumps({'stream': stream, 'seq': seq, 'remove': remove, 'html': ''.join(changed)})
+
+
+# The display got deltas only, this puts the whole chat in it again
+def redraw_after_stream(name1, name2, mode):
+    html = redraw_html(name1, name2, mode)
+
+    # Different from the value the display had before the reply, otherwise gradio leaves the patched page as it is
+    return f'{html}<!-- {next(stream_ids)} -->'
+
+
 def cai_chatbot_wrapper(text, state):
-    for history in chatbot_wrapper(text, state):
-        yield chat_html_wrapper(history, state['name1'], state['name2'], state['mode'])
+    yield from stream_display(chatbot_wrapper(text, state), state)
 
 
 def regenerate_wrapper(text, state):
     if (len(shared.history['visible']) == 1 and not shared.history['visible'][0][0]) or len(shared.history['internal']) == 0:
-        yield chat_html_wrapper(shared.history['visible'], state['name1'], state['name2'], state['mode'])
+        yield from stream_display([shared.history['visible']], state)
     else:
-        for history in chatbot_wrapper('', state, regenerate=True):
-            yield chat_html_wrapper(history, state['name1'], state['name2'], state['mode'])
+        yield from stream_display(chatbot_wrapper('', state, regenerate=True), state)
 
 
 def continue_wrapper(text, state):
     if (len(shared.history['visible']) == 1 and not shared.history['visible'][0][0]) or len(shared.history['internal']) == 0:
-        yield chat_html_wrapper(shared.history['visible'], state['name1'], state['name2'], state['mode'])
+        yield from stream_display([shared.history['visible']], state)
     else:
-        for history in chatbot_wrapper('', state, _continue=True):
-            yield chat_html_wrapper(history, state['name1'], state['name2'], state['mode'])
+        yield from stream_display(chatbot_wrapper('', state, _continue=True), state)
 
 
 def remove_last_message(name1, name2, mode):
@@ -313,6 +396,8 @@ def clear_html():
 def clear_chat_log(name1, name2, greeting, mode):
     shared.history['visible'] = []
     shared.history['internal'] = []
+    if chat_log is not None:
+        chat_log.replace()
 
     if greeting != '':
         shared.history['internal'] += [['<|BEGIN-VISIBLE-CHAT|>', greeting]]
@@ -375,20 +460,40 @@ def save_history(mode, timestamp=False):
 
         fname = f"Instruct_{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
     else:
-        if timestamp:
-            fname = f"{shared.character}_{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
-        else:
-            fname = f"{shared.character}_persistent.json"
+        # Only what changed since the last save is appended to the log
+        if not timestamp:
+            get_chat_log().save(shared.history['internal'], shared.history['visible'])
+            return get_chat_log().path
+
+        fname = f"{shared.character}_{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
 
     if not Path('logs').exists():
         Path('logs').mkdir()
 
+    # Downloads have the whole history, also the part that wasn't loaded
+    internal, visible = shared.history['internal'], shared.history['visible']
+    if mode != 'instruct':
+        get_chat_log().save(internal, visible)
+        internal, visible = get_chat_log().full_history()
+
     with open(Path(f'logs/{fname}'), 'w', encoding='utf-8') as f:
-        f.write(json.dumps({'data': shared.history['internal'], 'data_visible': shared.history['visible']}, indent=2))
+        f.write(json.dumps({'data': internal, 'data_visible': visible}, indent=2))
 
     return Path(f'logs/{fname}')
 
 
+chat_log = None
+
+
+def get_chat_log():
+    global chat_log
+    path = Path(f'logs/{shared.character}_persistent.jsonl')
+    if chat_log is None or chat_log.path != path:
+        chat_log = ChatLog(path)
+
+    return chat_log
+
+
 def load_history(file, name1, name2):
     file = file.decode('utf-8')
     try:
@@ -403,6 +508,9 @@ def load_history(file, name1, name2):
         shared.history['internal'] = tokenize_dialogue(file, name1, name2)
         shared.history['visible'] = copy.deepcopy(shared.history['internal'])
 
+    if chat_log is not None:
+        chat_log.replace()
+
 
 def replace_character_names(text, name1, name2):
     text = text.replace('{{user}}', name1).replace('{{char}}', name2)
@@ -500,15 +608,19 @@ def load_character(character, name1, name2, mode):
     if mode != 'instruct':
         shared.history['internal'] = []
         shared.history['visible'] = []
-        if Path(f'logs/{shared.character}_persistent.json').exists():
+        if get_chat_log().exists():
+            shared.history['internal'], shared.history['visible'] = get_chat_log().load(shared.args.chat_history_window)
+        elif Path(f'logs/{shared.character}_persistent.json').exists():
+            # Histories saved before the .jsonl logs, converted by the next save
             load_history(open(Path(f'logs/{shared.character}_persistent.json'), 'rb').read(), name1, name2)
+            save_history(mode)
         else:
             # Insert greeting if it exists
             if greeting != "":
                 shared.history['internal'] += [['<|BEGIN-VISIBLE-CHAT|>', greeting]]
                 shared.history['visible'] += [['', apply_extensions("output", greeting)]]
 
-            # Create .json log files since they don't already exist
+            # Create .jsonl log files since they don't already exist
             save_history(mode)
 
     return name1, name2, picture, greeting, context, repr(turn_template)[1:-1], chat_html_wrapper(shared.history['visible'], name1, name2, mode)
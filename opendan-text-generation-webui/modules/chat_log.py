@@ -0,0 +1,193 @@
+'''
+
+Append-only persistent chat histories (logs/{character}_persistent.jsonl).
+
+Instead of rewriting the whole history after every message, save() compares
+it with what is already in the log and only appends the difference, as one
+json record per line:
+
+    {"i": 12, "row": [internal, visible]}    row 12 of the history
+    {"truncate": 11}                         the history was cut to 11 rows
+
+A row is always written at the end of the history as it is at that point,
+so editing the last message is a truncate followed by the new row. When the
+log holds more than twice as many records as live rows, it is compacted.
+
+The byte offset of every record is appended to a .idx file (little-endian
+uint64), so that the last rows can be found by reading the log backwards:
+with --chat-history-window, only the last N rows of a long history are
+parsed when a character is loaded.
+
+'''
+
+import json
+import logging
+import os
+from array import array
+from pathlib import Path
+
+
+class ChatLog:
+    def __init__(self, path):
+        self.path = Path(path)
+        self.index_path = self.path.with_suffix('.idx')
+        self.offsets = array('Q')
+        self.length = 0  # number of rows in the log
+        self.base = 0  # position in the log of the first loaded row
+        self.rows = []  # the loaded rows as they are in the log, as tuples
+        if self.path.exists():
+            self._open()
+
+    def exists(self):
+        return self.path.exists()
+
+    def _open(self):
+        size = self.path.stat().st_size
+        try:
+            with open(self.index_path, 'rb') as f:
+                self.offsets.frombytes(f.read())
+        except (OSError, ValueError):
+            self.offsets = array('Q')
+
+        # The log or the index wasn't completely written (crash, or an older version), rebuild the index
+        if len(self.offsets) == 0 or self._record_end(self.offsets[-1]) != size:
+            self._rebuild_index()
+
+        if len(self.offsets) > 0:
+            record = self._read_record(len(self.offsets) - 1)
+            self.length = record['i'] + 1 if 'row' in record else record['truncate']
+
+    def _record_end(self, offset):
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            line = f.readline()
+
+        return offset + len(line) if line.endswith(b'\n') else -1
+
+    def _rebuild_index(self):
+        offsets = array('Q')
+        offset = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+
+                offsets.append(offset)
+                offset += len(line)
+
+        # Drops a partially written last record
+        os.truncate(self.path, offset)
+        with open(self.index_path, 'wb') as f:
+            f.write(offsets.tobytes())
+
+        self.offsets = offsets
+
+    def _read_record(self, n):
+        with open(self.path, 'rb') as f:
+            f.seek(self.offsets[n])
+            return json.loads(f.readline())
+
+    def _read_rows(self, start, end):
+        '''
+        Returns the rows start..end-1 of the history, reading the records
+        backwards from the end of the log until all of them are found.
+        '''
+        rows = [None] * (end - start)
+        missing = end - start
+        cut = self.length  # rows from here on were truncated by a later record
+        with open(self.path, 'rb') as f:
+            for n in range(len(self.offsets) - 1, -1, -1):
+                if missing == 0:
+                    break
+
+                f.seek(self.offsets[n])
+                record = json.loads(f.readline())
+                if 'truncate' in record:
+                    cut = min(cut, record['truncate'])
+                elif record['i'] < cut:
+                    # Later records for this row have already been seen, so this is its last version
+                    if start <= record['i'] < end and rows[record['i'] - start] is None:
+                        rows[record['i'] - start] = record['row']
+                        missing -= 1
+
+                    cut = record['i']
+
+        return rows
+
+    def load(self, window=0):
+        '''
+        Returns the internal and visible histories, only the last window
+        rows of them if window > 0.
+        '''
+        self.base = max(0, self.length - window) if window > 0 else 0
+        rows = self._read_rows(self.base, self.length)
+        self.rows = [(tuple(internal), tuple(visible)) for internal, visible in rows]
+        return [list(internal) for internal, _ in rows], [list(visible) for _, visible in rows]
+
+    def full_history(self):
+        '''
+        Returns the whole internal and visible histories as of the last
+        save(), also the rows that load() left out.
+        '''
+        rows = self._read_rows(0, self.base) + [[internal, visible] for internal, visible in self.rows]
+        return [list(internal) for internal, _ in rows], [list(visible) for _, visible in rows]
+
+    def save(self, internal, visible):
+        rows = [(tuple(a), tuple(b)) for a, b in zip(internal, visible)]
+        same = 0
+        while same < min(len(rows), len(self.rows)) and rows[same] == self.rows[same]:
+            same += 1
+
+        records = []
+        if self.base + same < self.length:
+            records.append({'truncate': self.base + same})
+        for i in range(same, len(rows)):
+            records.append({'i': self.base + i, 'row': [internal[i], visible[i]]})
+
+        if len(records) == 0:
+            return
+
+        self._append(records)
+        self.rows = rows
+        self.length = self.base + len(rows)
+        if len(self.offsets) > 2 * self.length + 64:
+            self.compact()
+
+    # The history was replaced as a whole (cleared, uploaded), the next save() writes it from the start
+    def replace(self):
+        self.base = 0
+        self.rows = []
+
+    def _append(self, records):
+        self.path.parent.mkdir(exist_ok=True)
+        offset = self.path.stat().st_size if self.path.exists() else 0
+        lines = [(json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8') for record in records]
+        offsets = array('Q')
+        for line in lines:
+            offsets.append(offset)
+            offset += len(line)
+
+        with open(self.path, 'ab') as f:
+            f.write(b''.join(lines))
+        with open(self.index_path, 'ab') as f:
+            f.write(offsets.tobytes())
+
+        self.offsets.extend(offsets)
+
+    # Rewrites the log with only the live rows
+    def compact(self):
+        rows = self._read_rows(0, self.length)
+        lines = [(json.dumps({'i': i, 'row': row}, ensure_ascii=False) + '\n').encode('utf-8') for i, row in enumerate(rows)]
+        offsets = array('Q', [0] * len(lines))
+        for i in range(1, len(lines)):
+            offsets[i] = offsets[i - 1] + len(lines[i - 1])
+
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(b''.join(lines))
+        with open(self.index_path, 'wb') as f:
+            f.write(offsets.tobytes())
+
+        os.replace(tmp_path, self.path)
+        self.offsets = offsets
+        logging.info(f'Compacted {self.path} to {len(rows)} rows.')
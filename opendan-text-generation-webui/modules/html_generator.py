@@ -4,10 +4,13 @@ This is a library for formatting text outputs as nice HTML.
 
 '''
 
+import hashlib
 import os
 import re
 import time
+from collections import OrderedDict
 from pathlib import Path
+from threading import Lock
 
 import markdown
 from PIL import Image, ImageOps
@@ -152,127 +155,163 @@ def get_image_cache(path):
     return image_cache[path][1]
 
 
-def generate_instruct_html(history):
-    output = f'<style>{instruct_css}</style><div class="chat" id="chat">'
-    for i, _row in enumerate(history[::-1]):
-        row = [convert_to_markdown(entry) for entry in _row]
-
-        output += f"""
+# The html of every (role, mode) message, filled in by render_message()
+message_templates = {
+    ('assistant', 'instruct'): """
               <div class="assistant-message">
                 <div class="text">
                   <div class="message-body">
-                    {row[1]}
+                    {body}
                   </div>
                 </div>
               </div>
-            """
-
-        if len(row[0]) == 0:  # don't display empty user messages
-            continue
-
-        output += f"""
+            """,
+    ('user', 'instruct'): """
               <div class="user-message">
                 <div class="text">
                   <div class="message-body">
-                    {row[0]}
+                    {body}
                   </div>
                 </div>
               </div>
-            """
-
-    output += "</div>"
-
-    return output
-
-
-def generate_cai_chat_html(history, name1, name2, reset_cache=False):
-    output = f'<style>{cai_css}</style><div class="chat" id="chat">'
-
-    # We use ?name2 and ?time.time() to force the browser to reset caches
-    img_bot = f'<img src="file/cache/pfp_character.png?{name2}">' if Path("cache/pfp_character.png").exists() else ''
-    img_me = f'<img src="file/cache/pfp_me.png?{time.time() if reset_cache else ""}">' if Path("cache/pfp_me.png").exists() else ''
-
-    for i, _row in enumerate(history[::-1]):
-        row = [convert_to_markdown(entry) for entry in _row]
-
-        output += f"""
+            """,
+    ('assistant', 'cai-chat'): """
               <div class="message">
                 <div class="circle-bot">
-                  {img_bot}
+                  {img}
                 </div>
                 <div class="text">
                   <div class="username">
-                    {name2}
+                    {name}
                   </div>
                   <div class="message-body">
-                    {row[1]}
+                    {body}
                   </div>
                 </div>
               </div>
-            """
-
-        if len(row[0]) == 0:  # don't display empty user messages
-            continue
-
-        output += f"""
+            """,
+    ('user', 'cai-chat'): """
               <div class="message">
                 <div class="circle-you">
-                  {img_me}
+                  {img}
                 </div>
                 <div class="text">
                   <div class="username">
-                    {name1}
+                    {name}
                   </div>
                   <div class="message-body">
-                    {row[0]}
+                    {body}
                   </div>
                 </div>
               </div>
-            """
-
-    output += "</div>"
-    return output
-
-
-def generate_chat_html(history, name1, name2, reset_cache=False):
-    output = f'<style>{bubble_chat_css}</style><div class="chat" id="chat">'
-
-    for i, _row in enumerate(history[::-1]):
-        row = [convert_to_markdown(entry) for entry in _row]
-
-        output += f"""
+            """,
+    ('assistant', 'chat'): """
               <div class="message">
                 <div class="text-bot">
                   <div class="message-body">
-                    {row[1]}
+                    {body}
                   </div>
                 </div>
               </div>
-            """
-
-        if len(row[0]) == 0:  # don't display empty user messages
-            continue
-
-        output += f"""
+            """,
+    ('user', 'chat'): """
               <div class="message">
                 <div class="text-you">
                   <div class="message-body">
-                    {row[0]}
+                    {body}
                   </div>
                 </div>
               </div>
-            """
+            """,
+}
+
+# Rendered messages, so that displaying the history again (after every
+# streamed token) only converts the message that changed. The message being
+# streamed isn't cached: each of its partial versions is displayed only once.
+render_cache = OrderedDict()
+render_cache_size = 4096
+render_cache_lock = Lock()  # several gradio workers render at the same time
+
+
+def render_message(text, role, mode, name='', img='', cache=True):
+    if not cache:
+        return message_templates[(role, mode)].format(body=convert_to_markdown(text), name=name, img=img)
+
+    key = (hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=16).digest(), role, mode, name, img)
+    with render_cache_lock:
+        html = render_cache.get(key)
+        if html is not None:
+            render_cache.move_to_end(key)
+            return html
+
+    # Rendered outside of the lock, the other sessions don't wait for it
+    html = message_templates[(role, mode)].format(body=convert_to_markdown(text), name=name, img=img)
+    with render_cache_lock:
+        render_cache[key] = html
+        while len(render_cache) > render_cache_size:
+            render_cache.popitem(last=False)
+
+    return html
+
+
+def generate_messages_html(history, mode, name1='', name2='', img_me='', img_bot='', streaming=False):
+    output = []
+    for i, row in enumerate(history[::-1]):
+        output.append(render_message(row[1], 'assistant', mode, name2, img_bot, cache=not (streaming and i == 0)))
+        if len(row[0]) == 0:  # don't display empty user messages
+            continue
+
+        output.append(render_message(row[0], 'user', mode, name1, img_me))
 
-    output += "</div>"
     return output
 
 
-def chat_html_wrapper(history, name1, name2, mode, reset_cache=False):
+def generate_instruct_html(history, streaming=False):
+    output = [f'<style>{instruct_css}</style><div class="chat" id="chat">']
+    output += generate_messages_html(history, 'instruct', streaming=streaming)
+    output.append("</div>")
+    return ''.join(output)
+
+
+def profile_pictures(name2, reset_cache=False):
+    # We use ?name2 and ?time.time() to force the browser to reset caches
+    img_bot = f'<img src="file/cache/pfp_character.png?{name2}">' if Path("cache/pfp_character.png").exists() else ''
+    img_me = f'<img src="file/cache/pfp_me.png?{time.time() if reset_cache else ""}">' if Path("cache/pfp_me.png").exists() else ''
+    return img_me, img_bot
+
+
+def generate_cai_chat_html(history, name1, name2, reset_cache=False, streaming=False):
+    output = [f'<style>{cai_css}</style><div class="chat" id="chat">']
+    img_me, img_bot = profile_pictures(name2, reset_cache)
+    output += generate_messages_html(history, 'cai-chat', name1, name2, img_me, img_bot, streaming=streaming)
+    output.append("</div>")
+    return ''.join(output)
+
+
+def generate_chat_html(history, name1, name2, reset_cache=False, streaming=False):
+    output = [f'<style>{bubble_chat_css}</style><div class="chat" id="chat">']
+    output += generate_messages_html(history, 'chat', streaming=streaming)
+    output.append("</div>")
+    return ''.join(output)
+
+
+def chat_html_wrapper(history, name1, name2, mode, reset_cache=False, streaming=False):
     if mode == "cai-chat":
-        return generate_cai_chat_html(history, name1, name2, reset_cache)
+        return generate_cai_chat_html(history, name1, name2, reset_cache, streaming=streaming)
     elif mode == "chat":
-        return generate_chat_html(history, name1, name2)
+        return generate_chat_html(history, name1, name2, streaming=streaming)
     elif mode == "instruct":
-        return generate_instruct_html(history)
+        return generate_instruct_html(history, streaming=streaming)
     else:
         return ''
+
+
+# The html of every message of the chat display, newest first
+def chat_messages_html(history, name1, name2, mode, streaming=False):
+    if mode == "cai-chat":
+        img_me, img_bot = profile_pictures(name2)
+        return generate_messages_html(history, mode, name1, name2, img_me, img_bot, streaming=streaming)
+    elif mode in ["chat", "instruct"]:
+        return generate_messages_html(history, mode, streaming=streaming)
+    else:
+        return []
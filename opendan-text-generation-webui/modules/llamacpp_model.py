@@ -50,8 +50,8 @@ class LlamaCppModel:
         for token in self.model.generate(tokens, top_k=top_k, top_p=top_p, temp=temperature, repeat_penalty=repetition_penalty):
             text = self.model.detokenize([token])
             output += text
-            if callback:
-                callback(text.decode())
+            if callback and callback(text.decode()):
+                break
 
             count += 1
             if count >= token_count or (token == self.model.token_eos()):
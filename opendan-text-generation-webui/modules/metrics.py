@@ -0,0 +1,194 @@
+'''
+
+Generation metrics, exported in the Prometheus text format.
+
+Every request gets a RequestMetrics that records where its time went
+(waiting in the queue, tokenization, prefill, time to first token, latency
+of every decode step) along with the number of generated tokens and the
+reason it stopped. The values are aggregated into histograms and counters
+labeled by backend; render() returns them for a /metrics endpoint.
+Disabled with --no-metrics.
+
+'''
+
+import threading
+import time
+
+import modules.shared as shared
+
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.15, 0.2, 0.3, 0.5, 0.75, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram:
+    def __init__(self, name, help, buckets=latency_buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, labels, value, count=1):
+        with self.lock:
+            if labels not in self.series:
+                self.series[labels] = [[0] * len(self.buckets), 0.0, 0]
+
+            series = self.series[labels]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += count
+
+            series[1] += value * count
+            series[2] += count
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            for labels, (bucket_counts, total, count) in sorted(self.series.items()):
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    lines.append(f'{self.name}_bucket{_format_labels(labels + (("le", str(bound)),))} {bucket_count}')
+
+                lines.append(f'{self.name}_bucket{_format_labels(labels + (("le", "+Inf"),))} {count}')
+                lines.append(f'{self.name}_sum{_format_labels(labels)} {total}')
+                lines.append(f'{self.name}_count{_format_labels(labels)} {count}')
+
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def inc(self, labels, value=1):
+        with self.lock:
+            self.series[labels] = self.series.get(labels, 0) + value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self.lock:
+            for labels, value in sorted(self.series.items()):
+                lines.append(f'{self.name}{_format_labels(labels)} {value}')
+
+        return lines
+
+
+def _format_labels(labels):
+    if len(labels) == 0:
+        return ''
+
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+
+queue_wait = Histogram('textgen_queue_wait_seconds', 'Time between the arrival of a request and the start of its generation.')
+tokenization = Histogram('textgen_tokenization_seconds', 'Time spent encoding the prompt.')
+prefill = Histogram('textgen_prefill_seconds', 'Time of the forward pass over the prompt.')
+time_to_first_token = Histogram('textgen_time_to_first_token_seconds', 'Time between the arrival of a request and its first generated token.')
+inter_token_latency = Histogram('textgen_inter_token_latency_seconds', 'Time between two generated tokens of the same request.')
+request_duration = Histogram('textgen_request_duration_seconds', 'Total time of a request, from its arrival to its last token.')
+generated_tokens = Counter('textgen_generated_tokens_total', 'Number of generated tokens.')
+requests = Counter('textgen_requests_total', 'Number of finished requests, by stop reason.')
+cache_reclaim = Histogram('textgen_cache_reclaim_seconds', 'Time spent in gc.collect() and torch.cuda.empty_cache(), by reason.')
+
+all_metrics = [queue_wait, tokenization, prefill, time_to_first_token, inter_token_latency, request_duration, generated_tokens, requests, cache_reclaim]
+
+
+class RequestMetrics:
+    def __init__(self, backend='unknown'):
+        self.backend = backend
+        self.enabled = not shared.args.no_metrics
+        self.t_arrival = time.perf_counter()
+        self.t_first_token = None
+        self.t_last_token = None
+        self.tokens = 0
+        self.finished = False
+
+    def _labels(self):
+        return (('backend', self.backend),)
+
+    def started(self):
+        if self.enabled:
+            queue_wait.observe(self._labels(), time.perf_counter() - self.t_arrival)
+
+    def observe_tokenization(self, seconds):
+        if self.enabled:
+            tokenization.observe(self._labels(), seconds)
+
+    def observe_prefill(self, seconds):
+        if self.enabled:
+            prefill.observe(self._labels(), seconds)
+
+    # Called when the first reply is produced, also by the backends that only count their tokens at the end.
+    # When streaming, the time since prefill_start is the prefill (and first decode step).
+    def first_token(self, prefill_start=None):
+        if not self.enabled or self.t_first_token is not None:
+            return
+
+        self.t_first_token = time.perf_counter()
+        time_to_first_token.observe(self._labels(), self.t_first_token - self.t_arrival)
+        if prefill_start is not None:
+            prefill.observe(self._labels(), self.t_first_token - prefill_start)
+
+    # n > 1 when several tokens arrive at once (non-streaming, FlexGen chunks...)
+    def add_tokens(self, n=1):
+        if not self.enabled or n <= 0:
+            return
+
+        now = time.perf_counter()
+        if self.t_last_token is None:
+            self.first_token()
+            if n > 1:
+                inter_token_latency.observe(self._labels(), 0.0, n - 1)
+        else:
+            inter_token_latency.observe(self._labels(), (now - self.t_last_token) / n, n)
+
+        self.t_last_token = now
+        self.tokens += n
+
+    def finish(self, stop_reason):
+        if not self.enabled or self.finished:
+            return
+
+        self.finished = True
+        request_duration.observe(self._labels(), time.perf_counter() - self.t_arrival)
+        generated_tokens.inc(self._labels(), self.tokens)
+        requests.inc(self._labels() + (('stop_reason', stop_reason),))
+
+
+def observe_cache_reclaim(reason, seconds):
+    if not shared.args.no_metrics:
+        cache_reclaim.observe((('reason', reason),), seconds)
+
+
+# The OpenAI API creates the metrics of a request when it arrives and hands
+# them to generate_reply through the generating thread.
+_current = threading.local()
+
+
+def set_current(request_metrics):
+    _current.metrics = request_metrics
+
+
+def begin_request(backend):
+    '''
+    Returns the RequestMetrics of the request being generated on this
+    thread (or a new one) and marks the end of its queue wait.
+    '''
+    request_metrics = getattr(_current, 'metrics', None)
+    _current.metrics = None
+    if request_metrics is None:
+        request_metrics = RequestMetrics(backend)
+    else:
+        request_metrics.backend = backend
+
+    request_metrics.started()
+    return request_metrics
+
+
+def render():
+    lines = []
+    for metric in all_metrics:
+        lines += metric.render()
+
+    return '\n'.join(lines) + '\n'
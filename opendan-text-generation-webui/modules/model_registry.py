@@ -0,0 +1,222 @@
+'''
+
+Several models loaded at the same time.
+
+The rest of the code works with the one model in shared.model,
+shared.tokenizer and shared.model_type. The registry keeps the other loaded
+models on the side and swaps them in when a request for them is served:
+use(name) makes a model the current one, loading it first if needed.
+
+Models are unloaded least recently used first when the loaded ones would
+take more than --model-memory-budget GiB, after the generations still
+running on the worker threads are done. With the default of 0, only one
+model is loaded at a time, like before.
+
+use() is only meant to be called from the thread that generates (the
+OpenAI API's scheduler). Other threads count tokens with tokenizer(name),
+which stays available while the models are swapped; the tokenizers are
+kept when their model is unloaded.
+
+'''
+
+import logging
+import re
+import time
+from collections import OrderedDict
+from pathlib import Path
+from threading import RLock
+
+import torch
+from transformers import AutoTokenizer
+
+import modules.prefix_cache as prefix_cache
+import modules.shared as shared
+from modules.callbacks import wait_for_generations
+from modules.models import clear_torch_cache, load_model
+
+
+class LoadedModel:
+    def __init__(self, name, model, tokenizer, model_type, lora_names, cache, nbytes):
+        self.name = name
+        self.model = model
+        self.tokenizer = tokenizer
+        self.model_type = model_type
+        self.lora_names = lora_names
+        self.prefix_cache = cache
+        self.nbytes = nbytes
+
+
+def get_available_models():
+    return sorted([re.sub('.pth$', '', item.name) for item in Path(f'{shared.args.model_dir}/').glob('*') if not item.name.endswith(('.txt', '-np', '.pt', '.json', '.yaml'))], key=str.lower)
+
+
+# What a model will take once loaded, from the size of its files
+def _file_bytes(name):
+    path = Path(f'{shared.args.model_dir}/{name}')
+    if not path.exists():
+        path = Path(f'{shared.args.model_dir}/{name}.pth')
+
+    if path.is_file():
+        return path.stat().st_size
+
+    return sum(f.stat().st_size for f in path.glob('**/*') if f.is_file())
+
+
+def _model_bytes(name, model):
+    if isinstance(model, torch.nn.Module):
+        return sum(t.numel() * t.element_size() for t in list(model.parameters()) + list(model.buffers()))
+
+    return _file_bytes(name)
+
+
+class ModelRegistry:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # the loaded models other than the current one, least recently used first
+        self.sizes = {}
+        self.tokenizers = {}
+        self.broken_tokenizers = set()  # not tried again until their model is loaded
+        self.available = []  # get_available_models(), refreshed when a name isn't in it
+        self.available_time = 0
+        self.default = None
+        self.lock = RLock()
+
+    def resolve(self, name):
+        '''
+        Returns the model that serves a request for name: name itself if it
+        is loaded or in the models folder, the default model otherwise
+        (clients send "gpt-3.5-turbo" and the like).
+        '''
+        if self.default is None:
+            self.default = shared.model_name
+
+        if name is None:
+            return self.default
+
+        with self.lock:
+            if name == shared.model_name or name in self.entries:
+                return name
+
+        return name if self._is_available(name) else self.default
+
+    # Names like gpt-3.5-turbo never are, the folder is listed again at most every 10 seconds
+    def _is_available(self, name):
+        if name not in self.available and time.time() - self.available_time > 10:
+            self.available = get_available_models()
+            self.available_time = time.time()
+
+        return name in self.available
+
+    def loaded_models(self):
+        with self.lock:
+            return [shared.model_name] + list(self.entries) if shared.model is not None else list(self.entries)
+
+    def is_loaded(self, name):
+        with self.lock:
+            return (name == shared.model_name and shared.model is not None) or name in self.entries
+
+    def tokenizer(self, name):
+        tokenizer = self.tokenizers.get(name)
+        if tokenizer is not None:
+            return tokenizer
+
+        with self.lock:
+            if name in self.tokenizers:
+                return self.tokenizers[name]
+            elif name == shared.model_name and shared.tokenizer is not None:
+                self.tokenizers[name] = shared.tokenizer
+                return shared.tokenizer
+
+            return self._load_tokenizer(name)
+
+    # For a model that wasn't loaded yet, replaced by the one load_model() returns when it is
+    def _load_tokenizer(self, name):
+        if name not in self.broken_tokenizers:
+            try:
+                self.tokenizers[name] = AutoTokenizer.from_pretrained(Path(f'{shared.args.model_dir}/{name}/'), trust_remote_code=shared.args.trust_remote_code)
+                return self.tokenizers[name]
+            except Exception:
+                logging.warning(f"Couldn't load the tokenizer of {name}, counting its tokens with the one of {self.default} until it is loaded.")
+                self.broken_tokenizers.add(name)
+
+        return self.tokenizers.get(self.default, shared.tokenizer)
+
+    def use(self, name):
+        if name == shared.model_name and shared.model is not None:
+            return
+
+        with self.lock:
+            previous = shared.model_name if shared.model is not None else None
+            self._stash_current()
+            entry = self.entries.pop(name, None)
+            nbytes = entry.nbytes if entry is not None else _file_bytes(name)
+            self._make_room(nbytes)
+            if entry is None:
+                try:
+                    entry = self._load(name)
+                except Exception:
+                    self._restore(previous)
+                    raise
+
+            self._activate(entry)
+
+    # After a failed load, the model that was current comes back, loaded again if it was unloaded to make room
+    def _restore(self, name):
+        if name is None:
+            return
+
+        entry = self.entries.pop(name, None)
+        if entry is None:
+            try:
+                entry = self._load(name)
+            except Exception:
+                logging.exception(f"Couldn't load {name} back.")
+                return
+
+        self._activate(entry)
+
+    def _stash_current(self):
+        if shared.model is None:
+            return
+
+        name = shared.model_name
+        if name not in self.sizes:
+            self.sizes[name] = _model_bytes(name, shared.model)
+
+        self.tokenizers[name] = shared.tokenizer
+        self.entries[name] = LoadedModel(name, shared.model, shared.tokenizer, shared.model_type, shared.lora_names, prefix_cache.prefix_cache, self.sizes[name])
+        shared.model = shared.tokenizer = None
+
+    def _make_room(self, nbytes):
+        unloaded = False
+        while len(self.entries) > 0 and sum(entry.nbytes for entry in self.entries.values()) + nbytes > self.max_bytes:
+            # A model still generating on a worker thread would stay in memory next to the new one
+            if not unloaded:
+                wait_for_generations()
+
+            name = self.entries.popitem(last=False)[0]
+            logging.info(f"Unloading {name} to make room.")
+            unloaded = True
+
+        if unloaded:
+            clear_torch_cache(force=True)
+
+    def _load(self, name):
+        # shared.model_name is only changed by _activate(), once the model is loaded
+        t0 = time.time()
+        model, tokenizer = load_model(name)
+        self.sizes[name] = _model_bytes(name, model)
+        self.tokenizers[name] = tokenizer
+        logging.info(f"Loaded {name} on demand in {(time.time()-t0):.2f} seconds.")
+        return LoadedModel(name, model, tokenizer, shared.model_type, [], prefix_cache.PrefixCache(shared.args.prefix_cache_size * 1024 * 1024), self.sizes[name])
+
+    def _activate(self, entry):
+        shared.model_name = entry.name
+        shared.model_type = entry.model_type
+        shared.lora_names = entry.lora_names
+        shared.tokenizer = entry.tokenizer
+        shared.model = entry.model
+        prefix_cache.prefix_cache = entry.prefix_cache
+
+
+registry = ModelRegistry(int(shared.args.model_memory_budget * 1024 ** 3))
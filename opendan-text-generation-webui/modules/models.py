@@ -15,8 +15,10 @@ from transformers import (AutoConfig, AutoModel, AutoModelForCausalLM,
                           AutoModelForSeq2SeqLM, AutoTokenizer,
                           BitsAndBytesConfig, LlamaTokenizer)
 
+import modules.metrics as metrics
 import modules.shared as shared
 from modules import llama_attn_hijack
+from modules.prefix_cache import clear_prefix_cache
 
 transformers.logging.set_verbosity_error()
 
@@ -253,15 +255,46 @@ def load_model(model_name):
     return model, tokenizer
 
 
-def clear_torch_cache():
+def clear_torch_cache(force=False):
+    '''
+    Runs gc.collect() and torch.cuda.empty_cache(), which take tens of
+    milliseconds with a model loaded, only when it's worth it: after a
+    model or LoRA change (force=True), or when the memory held by the CUDA
+    caching allocator crosses --cache-reclaim-threshold.
+    '''
+    reason = 'forced' if force else _memory_pressure()
+    if reason is None:
+        return
+
+    t0 = time.perf_counter()
     gc.collect()
-    if not shared.args.cpu:
+    if torch.cuda.is_available() and not shared.args.cpu:
         torch.cuda.empty_cache()
 
+    metrics.observe_cache_reclaim(reason, time.perf_counter() - t0)
+
+
+# Returns why the cache should be reclaimed, or None
+def _memory_pressure():
+    if shared.args.cpu or not torch.cuda.is_available():
+        return None
+
+    for device in range(torch.cuda.device_count()):
+        reserved = torch.cuda.memory_reserved(device)
+        if reserved == 0:
+            continue
+
+        total = torch.cuda.get_device_properties(device).total_memory
+        if reserved > shared.args.cache_reclaim_threshold * total:
+            return 'pressure'
+
+    return None
+
 
 def unload_model():
     shared.model = shared.tokenizer = None
-    clear_torch_cache()
+    clear_prefix_cache()
+    clear_torch_cache(force=True)
 
 
 def reload_model():
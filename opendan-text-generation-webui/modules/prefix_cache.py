@@ -0,0 +1,119 @@
+'''
+
+Reuses the past_key_values of previously seen prompts.
+
+Chat prompts start with the same character context followed by a mostly
+unchanged history, so most of the prefill of a new request has already been
+computed by the previous one. Entries are keyed by their token ids; a new
+prompt only prefills the tokens after the longest cached prefix. The cache
+is bounded by --prefix-cache-size (in MiB) with LRU eviction.
+
+'''
+
+from collections import OrderedDict
+from threading import Lock
+
+import numpy as np
+import torch
+
+import modules.shared as shared
+
+
+class PrefixCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    # Returns the length of the longest cached prefix of ids (up to max_length) and its past_key_values
+    def lookup(self, ids, max_length):
+        best_key, best_length = None, 0
+        with self.lock:
+            for key, (key_ids, _, _) in self.entries.items():
+                n = min(len(key_ids), max_length)
+                if n <= best_length:
+                    continue
+
+                mismatch = np.flatnonzero(key_ids[:n] != ids[:n])
+                length = int(mismatch[0]) if len(mismatch) > 0 else n
+                if length > best_length:
+                    best_key, best_length = key, length
+
+            if best_key is None:
+                self.misses += 1
+                return 0, None
+
+            self.hits += 1
+            self.entries.move_to_end(best_key)
+            past_key_values = self.entries[best_key][1]
+
+        return best_length, _truncate(past_key_values, best_length)
+
+    def store(self, ids, past_key_values):
+        nbytes = sum(t.numel() * t.element_size() for layer in past_key_values for t in layer)
+        if nbytes > self.max_bytes:
+            return
+
+        key = ids.tobytes()
+        with self.lock:
+            # Entries that are a prefix of the new one are superseded by it
+            for other in [k for k, (other_ids, _, _) in self.entries.items() if len(other_ids) <= len(ids) and np.array_equal(other_ids, ids[:len(other_ids)])]:
+                self.size -= self.entries.pop(other)[2]
+
+            self.entries[key] = (ids, past_key_values, nbytes)
+            self.size += nbytes
+            while self.size > self.max_bytes:
+                self.size -= self.entries.popitem(last=False)[1][2]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+def _truncate(past_key_values, length):
+    return tuple(tuple(t.narrow(-2, 0, length) for t in layer) for layer in past_key_values)
+
+
+prefix_cache = PrefixCache(shared.args.prefix_cache_size * 1024 * 1024)
+
+
+def model_supports_cache_reuse():
+    if shared.model is None or shared.model_type in ['rwkv', 'llamacpp', 'HF_seq2seq', 'chatglm']:
+        return False
+    if any((shared.args.flexgen, shared.args.deepspeed, shared.args.no_cache, shared.soft_prompt)):
+        return False
+
+    # BLOOM fuses the head and batch dimensions of its cache, so it can't be sliced like the others
+    return getattr(getattr(shared.model, 'config', None), 'model_type', None) != 'bloom'
+
+
+def is_enabled():
+    return shared.args.prefix_cache_size > 0 and model_supports_cache_reuse()
+
+
+def get_past_key_values(input_ids):
+    '''
+    Returns the past_key_values for all but the last token of input_ids
+    (a [1, n] tensor), only running the model on the uncached suffix.
+    '''
+    ids = input_ids[0].cpu().numpy()
+    target = len(ids) - 1
+    if target < 1:
+        return None
+
+    length, past_key_values = prefix_cache.lookup(ids, target)
+    if length < target:
+        with torch.no_grad():
+            past_key_values = shared.model(input_ids[:, length:target], past_key_values=past_key_values if length > 0 else None, use_cache=True, return_dict=True).past_key_values
+
+        prefix_cache.store(ids[:target], past_key_values)
+
+    return past_key_values
+
+
+def clear_prefix_cache():
+    prefix_cache.clear()
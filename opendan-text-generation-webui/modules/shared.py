@@ -97,6 +97,8 @@ parser.add_argument('--notebook', action='store_true', help='Launch the web UI i
 parser.add_argument('--chat', action='store_true', help='Launch the web UI in chat mode with a style similar to the Character.AI website.')
 parser.add_argument('--cai-chat', action='store_true', help='DEPRECATED: use --chat instead.')
 parser.add_argument('--character', type=str, help='The name of the character to load in chat mode by default.')
+parser.add_argument('--chat-history-window', type=int, default=0, help='Only load the last N messages of a persistent chat history when a character is loaded. 0 loads all of them.')
+parser.add_argument('--chat-delta-streaming', action='store_true', help='Stream only the chat messages that changed to the browser, instead of the whole chat for every token.')
 parser.add_argument('--model', type=str, help='Name of the model to load by default.')
 parser.add_argument('--lora', type=str, nargs="+", help='The list of LoRAs to load. If you want to load more than one LoRA, write the names separated by spaces.')
 parser.add_argument("--model-dir", type=str, default='models/', help="Path to directory with all the models")
@@ -106,6 +108,7 @@ parser.add_argument('--no-stream', action='store_true', help='Don\'t stream the
 parser.add_argument('--settings', type=str, help='Load the default interface settings from this json file. See settings-template.json for an example. If you create a file called settings.json, this file will be loaded by default without the need to use the --settings flag.')
 parser.add_argument('--extensions', type=str, nargs="+", help='The list of extensions to load. If you want to load more than one extension, write the names separated by spaces.')
 parser.add_argument('--verbose', action='store_true', help='Print the prompts to the terminal.')
+parser.add_argument('--no-metrics', action='store_true', help='Don\'t record the generation metrics (queue wait, time to first token, inter-token latency...) exported by the OpenAI API on /metrics.')
 
 # Accelerate/transformers
 parser.add_argument('--cpu', action='store_true', help='Use the CPU to generate text. Warning: Training on CPU is extremely slow.')
@@ -118,6 +121,9 @@ parser.add_argument('--load-in-8bit', action='store_true', help='Load the model
 parser.add_argument('--bf16', action='store_true', help='Load the model with bfloat16 precision. Requires NVIDIA Ampere GPU.')
 parser.add_argument('--no-cache', action='store_true', help='Set use_cache to False while generating text. This reduces the VRAM usage a bit at a performance cost.')
 parser.add_argument('--xformers', action='store_true', help="Use xformer's memory efficient attention. This should increase your tokens/s.")
+parser.add_argument('--model-memory-budget', type=float, default=0, help='Total size in GiB of the models that the OpenAI API can keep loaded at the same time. Requests are routed by their model field, and the least recently used models are unloaded to make room. With 0, only one model is loaded at a time.')
+parser.add_argument('--cache-reclaim-threshold', type=float, default=0.9, help='Only run gc.collect() and torch.cuda.empty_cache() before a generation when the memory reserved by PyTorch on a GPU is above this fraction of its total memory. They always run after the model or the LoRAs change.')
+parser.add_argument('--prefix-cache-size', type=int, default=0, help='Keep up to this many MiB of past_key_values from previous prompts, so that a new prompt only prefills the tokens after its longest cached prefix. 0 disables the cache.')
 parser.add_argument('--sdp-attention', action='store_true', help="Use torch 2.0's sdp attention.")
 parser.add_argument('--trust-remote-code', action='store_true', help="Set trust_remote_code=True while loading a model. Necessary for ChatGLM.")
 
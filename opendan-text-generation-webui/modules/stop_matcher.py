@@ -0,0 +1,124 @@
+'''
+
+Incremental matching of stopping strings.
+
+StopMatcher is an Aho-Corasick automaton over any kind of symbols
+(characters or token ids). It only consumes the symbols that were generated
+since the last call, so the cost per step doesn't depend on the number of
+stopping strings or on the length of the reply.
+
+'''
+
+from collections import deque
+
+
+class StopMatcher:
+    def __init__(self, patterns):
+        self.patterns = [tuple(p) for p in patterns if len(p) > 0]
+        self.goto = [{}]
+        self.fail = [0]
+        self.depth = [0]
+        self.output = [[]]
+
+        for idx, pattern in enumerate(self.patterns):
+            node = 0
+            for symbol in pattern:
+                if symbol not in self.goto[node]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.depth.append(self.depth[node] + 1)
+                    self.output.append([])
+                    self.goto[node][symbol] = len(self.goto) - 1
+
+                node = self.goto[node][symbol]
+
+            self.output[node].append(idx)
+
+        # Breadth-first pass to set the failure links
+        queue = deque(self.goto[0].values())
+        while len(queue) > 0:
+            node = queue.popleft()
+            for symbol, child in self.goto[node].items():
+                queue.append(child)
+                fallback = self.fail[node]
+                while fallback and symbol not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+
+                self.fail[child] = self.goto[fallback].get(symbol, 0)
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+
+        self.reset()
+
+    def reset(self):
+        self.state = 0
+        self.position = 0
+
+    def feed(self, symbols):
+        '''
+        Consumes new symbols and returns the start position (counted from
+        the first symbol ever fed) of the earliest starting match among
+        the ones that were completed, or None.
+        '''
+        start = None
+        for symbol in symbols:
+            state = self.state
+            while state and symbol not in self.goto[state]:
+                state = self.fail[state]
+
+            self.state = self.goto[state].get(symbol, 0)
+            self.position += 1
+            for idx in self.output[self.state]:
+                match_start = self.position - len(self.patterns[idx])
+                if start is None or match_start < start:
+                    start = match_start
+
+        return start
+
+    @property
+    def pending(self):
+        '''
+        Length of the longest suffix of the consumed symbols that is the
+        beginning of some pattern, ie. how much of the output should be held
+        back because it may still turn into a match.
+        '''
+        return self.depth[self.state]
+
+
+class TextStopMatcher:
+
+    """
+    Wraps a StopMatcher for callers that have the whole reply at every step.
+    Only the characters added since the previous call are consumed. If the
+    text was changed rather than extended (for instance a partial multibyte
+    character that got completed), it is scanned again from the start.
+    """
+
+    # Number of already consumed characters compared to make sure that the new text continues the old one
+    overlap_check = 16
+
+    def __init__(self, stopping_strings):
+        self.matcher = StopMatcher(stopping_strings)
+        self.text = ''
+        self.consumed = 0
+        self.stop_idx = None
+
+    def update(self, text):
+        '''
+        Returns the index where text should be cut because of a stopping
+        string (or None), and the number of trailing characters that may be
+        the beginning of a stopping string.
+        '''
+        consumed = self.consumed
+        tail = max(consumed - self.overlap_check, 0)
+        if len(text) < consumed or text[tail:consumed] != self.text[tail:consumed]:
+            # The text was rewritten instead of extended
+            self.matcher.reset()
+            self.stop_idx = None
+            consumed = 0
+
+        if self.stop_idx is None:
+            self.stop_idx = self.matcher.feed(text[consumed:])
+            self.text = text
+            self.consumed = len(text)
+
+        return self.stop_idx, self.matcher.pending if self.stop_idx is None else 0
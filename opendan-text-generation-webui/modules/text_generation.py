@@ -1,20 +1,25 @@
 import ast
+import hashlib
 import logging
 import random
 import re
 import time
 import traceback
+from collections import OrderedDict
+from threading import Lock
 
 import numpy as np
 import torch
 import transformers
 
+import modules.metrics as metrics
 import modules.shared as shared
 from modules.callbacks import (Iteratorize, Stream,
                                _SentinelTokenStoppingCriteria)
 from modules.extensions import apply_extensions
 from modules.html_generator import generate_4chan_html, generate_basic_html
 from modules.models import clear_torch_cache, local_rank
+from modules.prefix_cache import get_past_key_values, is_enabled
 
 
 def get_max_prompt_length(state):
@@ -59,10 +64,101 @@ def encode(prompt, add_special_tokens=True, add_bos_token=True, truncation_lengt
         return input_ids.cuda()
 
 
+# Token counts of strings that get tokenized over and over, like chat turns or
+# the messages that API clients resend on every request. Keyed by content hash,
+# with one cache per tokenizer since the API can switch between models.
+token_count_caches = OrderedDict()  # id(tokenizer) -> (tokenizer, cache)
+token_count_cache_size = 65536
+token_count_max_tokenizers = 4
+token_count_lock = Lock()
+
+
+def count_tokens_batch(texts, tokenizer=None):
+    if tokenizer is None:
+        tokenizer = shared.tokenizer
+
+    keys = [hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=16).digest() for text in texts]
+    counts = [None] * len(texts)
+    with token_count_lock:
+        if id(tokenizer) not in token_count_caches:
+            token_count_caches[id(tokenizer)] = (tokenizer, OrderedDict())
+            while len(token_count_caches) > token_count_max_tokenizers:
+                token_count_caches.popitem(last=False)
+
+        token_count_caches.move_to_end(id(tokenizer))
+        token_count_cache = token_count_caches[id(tokenizer)][1]
+        for i, key in enumerate(keys):
+            if key in token_count_cache:
+                token_count_cache.move_to_end(key)
+                counts[i] = token_count_cache[key]
+
+    misses = [i for i in range(len(texts)) if counts[i] is None]
+    if len(misses) == 0:
+        return counts
+
+    # All the missing strings are tokenized in a single call
+    # The tokenizer may not be the current model's, so the rwkv and llama.cpp ones are told apart by their type
+    if isinstance(tokenizer, transformers.PreTrainedTokenizerBase):
+        ids = tokenizer([texts[i] for i in misses], add_special_tokens=False)['input_ids']
+    else:
+        ids = [tokenizer.encode(texts[i]) for i in misses]
+
+    is_llama = type(tokenizer) is transformers.LlamaTokenizer
+    with token_count_lock:
+        for i, input_ids in zip(misses, ids):
+            # Same as in encode()
+            counts[i] = len(input_ids) - (1 if is_llama and len(input_ids) > 0 and input_ids[0] == 29871 else 0)
+            token_count_cache[keys[i]] = counts[i]
+
+        while len(token_count_cache) > token_count_cache_size:
+            token_count_cache.popitem(last=False)
+
+    return counts
+
+
+def count_tokens(text):
+    return count_tokens_batch([text])[0]
+
+
 def decode(output_ids, skip_special_tokens=True):
     return shared.tokenizer.decode(output_ids, skip_special_tokens)
 
 
+class IncrementalDetokenizer:
+
+    """
+    Decodes a stream of generated tokens without decoding all of them again
+    on every step. Only a small window made of the previous token(s) and the
+    new ones is decoded; keeping the previous tokens in the window takes care
+    of SentencePiece leading spaces, and text ending in an incomplete UTF-8
+    sequence is held back until the next tokens complete it.
+    """
+
+    def __init__(self, skip_special_tokens=True):
+        self.skip_special_tokens = skip_special_tokens
+        self.ids = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+        self.text = ''
+
+    @property
+    def token_count(self):
+        return len(self.ids)
+
+    def add(self, new_ids):
+        self.ids.extend(new_ids)
+        prefix_text = decode(self.ids[self.prefix_offset:self.read_offset], self.skip_special_tokens)
+        new_text = decode(self.ids[self.prefix_offset:], self.skip_special_tokens)
+        if len(new_text) <= len(prefix_text) or new_text.endswith('\ufffd'):
+            return ''
+
+        delta = new_text[len(prefix_text):]
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.ids)
+        self.text += delta
+        return delta
+
+
 def generate_softprompt_input_tensors(input_ids):
     inputs_embeds = shared.model.transformer.wte(input_ids)
     inputs_embeds = torch.cat((shared.soft_prompt_tensor, inputs_embeds), dim=1)
@@ -93,21 +189,35 @@ def fix_galactica(s):
     return s
 
 
-def get_reply_from_output_ids(output_ids, input_ids, original_question, state):
+def get_reply_from_output_ids(output_ids, input_ids, original_question, state, detokenizer=None):
     if shared.model_type == 'HF_seq2seq':
         reply = decode(output_ids, state['skip_special_tokens'])
         if not shared.is_chat():
             reply = apply_extensions('output', reply)
     else:
+        if detokenizer is not None:
+            # While streaming, only the tokens that weren't seen yet are decoded
+            return get_reply_from_new_ids(output_ids[len(input_ids[0]) + detokenizer.token_count:].tolist(), original_question, state, detokenizer)
+
         new_tokens = len(output_ids) - len(input_ids[0])
-        reply = decode(output_ids[-new_tokens:], state['skip_special_tokens'])
+        reply = _finish_reply(decode(output_ids[-new_tokens:], state['skip_special_tokens']), original_question)
+
+    return reply
 
-        if type(shared.tokenizer) is transformers.LlamaTokenizer:
-            if len(original_question) > 0 and original_question[-1] not in [' ', '\n']:
-                reply = ' ' + reply
 
-        if not shared.is_chat():
-            reply = original_question + apply_extensions('output', reply)
+# Same as above for a decoder-only model, given only the ids generated since the previous call
+def get_reply_from_new_ids(new_ids, original_question, state, detokenizer):
+    detokenizer.add(new_ids)
+    return _finish_reply(detokenizer.text, original_question)
+
+
+def _finish_reply(reply, original_question):
+    if type(shared.tokenizer) is transformers.LlamaTokenizer:
+        if len(original_question) > 0 and original_question[-1] not in [' ', '\n']:
+            reply = ' ' + reply
+
+    if not shared.is_chat():
+        reply = original_question + apply_extensions('output', reply)
 
     return reply
 
@@ -187,8 +297,12 @@ def generate_reply_HF(question, original_question, seed, state, eos_token=None,
     if shared.args.deepspeed:
         generate_params.update({'synced_gpus': True})
 
+    request_metrics = metrics.begin_request('transformers')
+
     # Encode the input
+    t_encode = time.perf_counter()
     input_ids = encode(question, add_bos_token=state['add_bos_token'], truncation_length=get_max_prompt_length(state))
+    request_metrics.observe_tokenization(time.perf_counter() - t_encode)
     output = input_ids[0]
     cuda = not any((shared.args.cpu, shared.args.deepspeed))
 
@@ -210,6 +324,9 @@ def generate_reply_HF(question, original_question, seed, state, eos_token=None,
         generate_params.update({'inputs': input_ids})
         if inputs_embeds is not None:
             generate_params.update({'inputs_embeds': inputs_embeds})
+        elif is_enabled():
+            # Only prefill the tokens after the longest cached prefix
+            generate_params.update({'past_key_values': get_past_key_values(input_ids)})
 
     # Create the StoppingCriteriaList with the stopping strings (needs to be done after tokenizer extensions)
     stopping_criteria_list = transformers.StoppingCriteriaList()
@@ -224,6 +341,8 @@ def generate_reply_HF(question, original_question, seed, state, eos_token=None,
     generate_params['stopping_criteria'] = stopping_criteria_list
 
     t0 = time.time()
+    stop_reason = 'stop'
+    generated_ids = None
     try:
         if not shared.is_chat() and shared.model_type != 'HF_seq2seq':
             yield original_question
@@ -238,37 +357,56 @@ def generate_reply_HF(question, original_question, seed, state, eos_token=None,
             if shared.soft_prompt:
                 output = torch.cat((input_ids[0], output[filler_input_ids.shape[1]:]))
 
+            request_metrics.first_token()
             yield get_reply_from_output_ids(output, input_ids, original_question, state)
 
         # Stream the reply 1 token at a time.
         # This is based on the trick of using 'stopping_criteria' to create an iterator.
         else:
 
+            # The worker thread may start after the API has swapped in another model
+            model = shared.model
+            starting_idx = 0 if shared.model_type == 'HF_seq2seq' else generate_params['inputs'].shape[-1]
+
             def generate_with_callback(callback=None, **kwargs):
-                kwargs['stopping_criteria'].append(Stream(callback_func=callback))
-                clear_torch_cache()
+                # Only the ids generated since the previous step are sent to the consumer
+                kwargs['stopping_criteria'].append(Stream(callback_func=callback, starting_idx=starting_idx))
                 with torch.no_grad():
-                    shared.model.generate(**kwargs)
+                    model.generate(**kwargs)
 
             def generate_with_streaming(**kwargs):
                 return Iteratorize(generate_with_callback, kwargs, callback=None)
 
+            detokenizer = IncrementalDetokenizer(state['skip_special_tokens'])
+            generated_ids = []
+            t_prefill = time.perf_counter()
             with generate_with_streaming(**generate_params) as generator:
-                for output in generator:
-                    if shared.soft_prompt:
-                        output = torch.cat((input_ids[0], output[filler_input_ids.shape[1]:]))
-
-                    yield get_reply_from_output_ids(output, input_ids, original_question, state)
-                    if output[-1] in eos_token_ids:
+                for new_ids in generator:
+                    generated_ids += new_ids
+                    request_metrics.first_token(t_prefill)
+                    request_metrics.add_tokens(len(new_ids))
+                    if shared.model_type == 'HF_seq2seq':
+                        yield get_reply_from_output_ids(generated_ids, input_ids, original_question, state)
+                    else:
+                        yield get_reply_from_new_ids(new_ids, original_question, state, detokenizer)
+
+                    if len(new_ids) > 0 and new_ids[-1] in eos_token_ids:
                         break
 
     except Exception:
         traceback.print_exc()
+        stop_reason = 'error'
     finally:
         t1 = time.time()
         original_tokens = len(original_input_ids[0])
-        new_tokens = len(output) - (original_tokens if shared.model_type != 'HF_seq2seq' else 0)
+        if generated_ids is not None:
+            new_tokens = len(generated_ids)
+        else:
+            new_tokens = len(output) - (original_tokens if shared.model_type != 'HF_seq2seq' else 0)
+
         print(f'Output generated in {(t1-t0):.2f} seconds ({new_tokens/(t1-t0):.2f} tokens/s, {new_tokens} tokens, context {original_tokens}, seed {seed})')
+        request_metrics.add_tokens(new_tokens - request_metrics.tokens)
+        request_metrics.finish(stop_reason if stop_reason == 'error' or new_tokens < state['max_new_tokens'] else 'length')
         return
 
 
@@ -278,7 +416,9 @@ def generate_reply_custom(question, original_question, seed, state, eos_token=No
     for k in ['temperature', 'top_p', 'top_k', 'repetition_penalty']:
         generate_params[k] = state[k]
 
+    request_metrics = metrics.begin_request(shared.model_type)
     t0 = time.time()
+    stop_reason = 'stop'
     try:
         if not shared.is_chat():
             yield question
@@ -289,10 +429,14 @@ def generate_reply_custom(question, original_question, seed, state, eos_token=No
             if not shared.is_chat():
                 reply = original_question + apply_extensions('output', reply)
 
+            request_metrics.first_token()
             yield reply
         else:
 
+            t_prefill = time.perf_counter()
             for reply in shared.model.generate_with_streaming(context=question, **generate_params):
+                request_metrics.first_token(t_prefill)
+                request_metrics.add_tokens()
                 output = original_question + reply
                 if not shared.is_chat():
                     reply = original_question + apply_extensions('output', reply)
@@ -301,11 +445,14 @@ def generate_reply_custom(question, original_question, seed, state, eos_token=No
 
     except Exception:
         traceback.print_exc()
+        stop_reason = 'error'
     finally:
         t1 = time.time()
         original_tokens = len(encode(original_question)[0])
         new_tokens = len(encode(output)[0]) - original_tokens
         print(f'Output generated in {(t1-t0):.2f} seconds ({new_tokens/(t1-t0):.2f} tokens/s, {new_tokens} tokens, context {original_tokens}, seed {seed})')
+        request_metrics.add_tokens(new_tokens - request_metrics.tokens)
+        request_metrics.finish(stop_reason if stop_reason == 'error' or new_tokens < state['max_new_tokens'] else 'length')
         return
 
 
@@ -317,8 +464,12 @@ def generate_reply_flexgen(question, original_question, seed, state, eos_token=N
     if state['stream']:
         generate_params['max_new_tokens'] = 8
 
+    request_metrics = metrics.begin_request('flexgen')
+
     # Encode the input
+    t_encode = time.perf_counter()
     input_ids = encode(question, add_bos_token=state['add_bos_token'], truncation_length=get_max_prompt_length(state))
+    request_metrics.observe_tokenization(time.perf_counter() - t_encode)
     output = input_ids[0]
 
     # Find the eos tokens
@@ -337,6 +488,7 @@ def generate_reply_flexgen(question, original_question, seed, state, eos_token=N
     generate_params['stop'] = eos_token_ids[-1]
 
     t0 = time.time()
+    stop_reason = 'stop'
     try:
         if not shared.is_chat():
             yield question
@@ -346,6 +498,7 @@ def generate_reply_flexgen(question, original_question, seed, state, eos_token=N
             with torch.no_grad():
                 output = shared.model.generate(**generate_params)[0]
 
+            request_metrics.first_token()
             yield get_reply_from_output_ids(output, input_ids, original_question, state)
 
         # Stream the output naively for FlexGen since it doesn't support 'stopping_criteria'
@@ -354,22 +507,27 @@ def generate_reply_flexgen(question, original_question, seed, state, eos_token=N
                 if shared.stop_everything:
                     break
 
-                clear_torch_cache()
                 with torch.no_grad():
                     output = shared.model.generate(**generate_params)[0]
 
                 if np.count_nonzero(np.isin(input_ids[0], eos_token_ids)) < np.count_nonzero(np.isin(output, eos_token_ids)):
                     break
 
+                # The first chunk has several tokens, the prefill can't be told apart from their decoding
+                request_metrics.first_token()
+                request_metrics.add_tokens(len(output) - len(original_input_ids[0]) - request_metrics.tokens)
                 yield get_reply_from_output_ids(output, original_input_ids, original_question, state)
                 input_ids = np.reshape(output, (1, output.shape[0]))
                 generate_params.update({'inputs': input_ids})
 
     except Exception:
         traceback.print_exc()
+        stop_reason = 'error'
     finally:
         t1 = time.time()
         original_tokens = len(original_input_ids[0])
         new_tokens = len(output) - (original_tokens if shared.model_type != 'HF_seq2seq' else 0)
         print(f'Output generated in {(t1-t0):.2f} seconds ({new_tokens/(t1-t0):.2f} tokens/s, {new_tokens} tokens, context {original_tokens}, seed {seed})')
+        request_metrics.add_tokens(new_tokens - request_metrics.tokens)
+        request_metrics.finish(stop_reason if stop_reason == 'error' or new_tokens < state['max_new_tokens'] else 'length')
         return
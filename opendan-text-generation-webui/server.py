@@ -524,6 +524,7 @@ def create_interface():
 
             with gr.Tab('Text generation', elem_id='main'):
                 shared.gradio['display'] = gr.HTML(value=chat_html_wrapper(shared.history['visible'], shared.settings['name1'], shared.settings['name2'], 'cai-chat'))
+                shared.gradio['display_delta'] = gr.Textbox(visible=False)
                 shared.gradio['textbox'] = gr.Textbox(label='Input')
                 with gr.Row():
                     shared.gradio['Stop'] = gr.Button('Stop', elem_id='stop')
@@ -720,32 +721,41 @@ def create_interface():
             clear_arr = [shared.gradio[k] for k in ['Clear history-confirm', 'Clear history', 'Clear history-cancel']]
             reload_inputs = [shared.gradio[k] for k in ['name1', 'name2', 'mode']]
 
+            # With --chat-delta-streaming, the replies are streamed to the hidden display_delta
+            stream_output = shared.gradio['display_delta'] if shared.args.chat_delta_streaming else shared.gradio['display']
+
             gen_events.append(shared.gradio['Generate'].click(
                 ui.gather_interface_values, [shared.gradio[k] for k in shared.input_elements], shared.gradio['interface_state']).then(
                 lambda x: (x, ''), shared.gradio['textbox'], [shared.gradio['Chat input'], shared.gradio['textbox']], show_progress=False).then(
-                chat.cai_chatbot_wrapper, shared.input_params, shared.gradio['display'], show_progress=False).then(
+                chat.cai_chatbot_wrapper, shared.input_params, stream_output, show_progress=False).then(
                 chat.save_history, shared.gradio['mode'], None, show_progress=False)
             )
 
             gen_events.append(shared.gradio['textbox'].submit(
                 ui.gather_interface_values, [shared.gradio[k] for k in shared.input_elements], shared.gradio['interface_state']).then(
                 lambda x: (x, ''), shared.gradio['textbox'], [shared.gradio['Chat input'], shared.gradio['textbox']], show_progress=False).then(
-                chat.cai_chatbot_wrapper, shared.input_params, shared.gradio['display'], show_progress=False).then(
+                chat.cai_chatbot_wrapper, shared.input_params, stream_output, show_progress=False).then(
                 chat.save_history, shared.gradio['mode'], None, show_progress=False)
             )
 
             gen_events.append(shared.gradio['Regenerate'].click(
                 ui.gather_interface_values, [shared.gradio[k] for k in shared.input_elements], shared.gradio['interface_state']).then(
-                chat.regenerate_wrapper, shared.input_params, shared.gradio['display'], show_progress=False).then(
+                chat.regenerate_wrapper, shared.input_params, stream_output, show_progress=False).then(
                 chat.save_history, shared.gradio['mode'], None, show_progress=False)
             )
 
             gen_events.append(shared.gradio['Continue'].click(
                 ui.gather_interface_values, [shared.gradio[k] for k in shared.input_elements], shared.gradio['interface_state']).then(
-                chat.continue_wrapper, shared.input_params, shared.gradio['display'], show_progress=False).then(
+                chat.continue_wrapper, shared.input_params, stream_output, show_progress=False).then(
                 chat.save_history, shared.gradio['mode'], None, show_progress=False)
             )
 
+            if shared.args.chat_delta_streaming:
+                for event in gen_events[-4:]:
+                    event.then(chat.redraw_after_stream, reload_inputs, shared.gradio['display'], show_progress=False)
+
+                shared.gradio['display_delta'].change(None, shared.gradio['display_delta'], None, _js='(x) => {applyChatDelta(x); return []}')
+
             gen_events.append(shared.gradio['Impersonate'].click(
                 ui.gather_interface_values, [shared.gradio[k] for k in shared.input_elements], shared.gradio['interface_state']).then(
                 chat.impersonate_wrapper, shared.input_params, shared.gradio['textbox'], show_progress=False)
@@ -771,9 +781,10 @@ def create_interface():
                 chat.clear_chat_log, [shared.gradio[k] for k in ['name1', 'name2', 'greeting', 'mode']], shared.gradio['display']).then(
                 chat.save_history, shared.gradio['mode'], None, show_progress=False)
 
+            # With --chat-delta-streaming, a cancelled reply never gets to its redraw_after_stream, the patched display is redrawn here
             shared.gradio['Stop'].click(
                 stop_everything_event, None, None, queue=False, cancels=gen_events if shared.args.no_stream else None).then(
-                chat.redraw_html, reload_inputs, shared.gradio['display'])
+                chat.redraw_after_stream if shared.args.chat_delta_streaming else chat.redraw_html, reload_inputs, shared.gradio['display'])
 
             shared.gradio['mode'].change(
                 lambda x: gr.update(visible=x == 'instruct'), shared.gradio['mode'], shared.gradio['instruction_template']).then(
@@ -0,0 +1,84 @@
+import sys
+from array import array
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from modules.chat_log import ChatLog
+
+
+def history(n, edited=()):
+    internal = [[f'question {i}', f'answer {i}{" (edited)" if i in edited else ""}'] for i in range(n)]
+    visible = [[f'<p>question {i}</p>', f'<p>{answer}</p>'] for i, (_, answer) in enumerate(internal)]
+    return internal, visible
+
+
+# The offsets in the .idx file are the starts of the lines of the log
+def check_index(log):
+    offsets = array('Q')
+    offsets.frombytes(log.index_path.read_bytes())
+    starts = [0]
+    for line in log.path.read_bytes().splitlines(keepends=True)[:-1]:
+        starts.append(starts[-1] + len(line))
+
+    assert list(offsets) == starts
+    assert list(log.offsets) == starts
+
+
+def test_save_and_load(tmp_path):
+    path = tmp_path / 'character_persistent.jsonl'
+    log = ChatLog(path)
+    log.save(*history(3))
+    log.save(*history(5))
+    log.save(*history(5, edited=[4]))
+    log.save(*history(4))
+
+    assert ChatLog(path).load() == history(4)
+    check_index(ChatLog(path))
+
+
+def test_windowed_load(tmp_path):
+    path = tmp_path / 'character_persistent.jsonl'
+    ChatLog(path).save(*history(10))
+
+    log = ChatLog(path)
+    internal, visible = log.load(window=3)
+    assert (internal, visible) == tuple(rows[7:] for rows in history(10))
+    assert log.full_history() == history(10)
+
+    # The rows that weren't loaded are kept as they are
+    internal, visible = history(12, edited=[9])
+    log.save(internal[7:], visible[7:])
+    assert log.full_history() == history(12, edited=[9])
+    assert ChatLog(path).load() == history(12, edited=[9])
+
+
+def test_compact(tmp_path):
+    path = tmp_path / 'character_persistent.jsonl'
+    log = ChatLog(path)
+    log.save(*history(4))
+    for i in range(100):
+        log.save(*history(4, edited=[3] if i % 2 == 0 else []))
+
+    # Compacted at least once, with an index that matches the new log
+    assert len(log.offsets) < 100
+    check_index(log)
+    assert ChatLog(path).load() == history(4)
+
+    log = ChatLog(path)
+    log.load(window=2)
+    log.compact()
+    check_index(log)
+    assert log.full_history() == history(4)
+    assert ChatLog(path).load(window=2) == tuple(rows[2:] for rows in history(4))
+
+
+def test_partial_record_is_dropped(tmp_path):
+    path = tmp_path / 'character_persistent.jsonl'
+    ChatLog(path).save(*history(3))
+    with open(path, 'ab') as f:
+        f.write(b'{"i": 3, "row": [["question')
+
+    log = ChatLog(path)
+    assert log.load() == history(3)
+    check_index(log)
@@ -0,0 +1,86 @@
+import sys
+from contextlib import ExitStack
+from pathlib import Path
+from threading import Event
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.argv = sys.argv[:1]  # modules.shared parses the command line
+
+import extensions.openai.scheduler as scheduler
+import modules.model_registry as model_registry
+from modules import shared
+from modules.model_registry import registry
+
+
+# Models 'a' (loaded) and 'b', each taking the whole memory budget, with a
+# generate_reply that waits for gate and then yields 5 replies
+def fake_models(stack, load_model, gate):
+    def generate_reply(prompt, state, stopping_strings=None):
+        gate.wait()
+        for i in range(5):
+            yield f'{prompt} {i}'
+
+    shared.model_name = 'a'
+    shared.model = object()
+    shared.tokenizer = object()
+    registry.max_bytes = 0
+    registry.default = None
+    registry.entries.clear()
+    stack.enter_context(mock.patch.object(model_registry, 'load_model', side_effect=load_model))
+    stack.enter_context(mock.patch.object(model_registry, 'get_available_models', return_value=['a', 'b']))
+    stack.enter_context(mock.patch.object(model_registry, '_file_bytes', return_value=1))
+    stack.enter_context(mock.patch.object(model_registry, '_model_bytes', return_value=1))
+    stack.enter_context(mock.patch.object(model_registry, 'clear_torch_cache'))
+    stack.enter_context(mock.patch.object(scheduler, 'supports_batching', return_value=False))
+    stack.enter_context(mock.patch.object(scheduler, 'generate_reply', side_effect=generate_reply))
+
+
+def test_interleaved_requests_load_each_model_once():
+    loads = []
+    gate = Event()
+
+    def load_model(name):
+        loads.append(name)
+        return object(), object()
+
+    with ExitStack() as stack:
+        fake_models(stack, load_model, gate)
+        batch_scheduler = scheduler.BatchScheduler(model_slice=60)
+        requests = [batch_scheduler.submit(f'{model}{i}', {}, model=model) for i in range(4) for model in ['a', 'b']]
+        gate.set()
+        for request in requests:
+            assert list(request)[-1] == f'{request.prompt} 4'
+
+    # Without the model slice, a and b were swapped (and b loaded) at every reply
+    assert loads == ['b']
+
+
+def test_failed_load_finishes_its_requests_and_restores_the_previous_model():
+    loads = []
+    gate = Event()
+    gate.set()
+
+    def load_model(name):
+        loads.append(name)
+        if name == 'b':
+            raise OSError('broken model')
+
+        return object(), object()
+
+    with ExitStack() as stack:
+        fake_models(stack, load_model, gate)
+        batch_scheduler = scheduler.BatchScheduler(model_slice=0)
+        request = batch_scheduler.submit('b0', {}, model='b')
+        assert list(request) == []
+        assert request.finish_reason == 'error'
+
+        # 'a' was unloaded to make room for 'b', and is loaded back
+        assert shared.model_name == 'a'
+        assert shared.model is not None
+
+        request = batch_scheduler.submit('a0', {}, model='a')
+        assert list(request)[-1] == 'a0 4'
+        assert request.finish_reason == 'stop'
+
+    assert loads == ['b', 'a']
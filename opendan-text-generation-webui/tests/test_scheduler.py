@@ -0,0 +1,135 @@
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
+
+import torch
+import torch.nn.functional as F
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.argv = sys.argv[:1]  # modules.shared parses the command line
+
+import extensions.openai.scheduler as scheduler
+from modules import shared
+
+
+# Predicts the next integer. Its cache keeps the position (keys) and the
+# id (values) of every token, and like gpt_neox it doesn't look at the
+# attention mask for the positions.
+class CountingModel:
+    config = SimpleNamespace(model_type='stub')
+    vocab_size = 64
+
+    def prepare_inputs_for_generation(self, input_ids, past_key_values=None, attention_mask=None, use_cache=None):
+        if past_key_values is not None:
+            input_ids = input_ids[:, -1:]
+
+        return {'input_ids': input_ids, 'past_key_values': past_key_values, 'attention_mask': attention_mask, 'use_cache': use_cache}
+
+    def forward(self, input_ids, past_key_values=None, attention_mask=None, position_ids=None, use_cache=None, return_dict=None):
+        if position_ids is None:
+            past_length = 0 if past_key_values is None else past_key_values[0][0].shape[-2]
+            position_ids = torch.arange(past_length, past_length + input_ids.shape[1]).expand_as(input_ids)
+
+        keys = position_ids[:, None, :, None].float()
+        values = input_ids[:, None, :, None].float()
+        if past_key_values is not None:
+            keys = torch.cat((past_key_values[0][0], keys), dim=-2)
+            values = torch.cat((past_key_values[0][1], values), dim=-2)
+
+        logits = F.one_hot((input_ids + 1) % self.vocab_size, self.vocab_size).float()
+        return SimpleNamespace(logits=logits, past_key_values=((keys, values),))
+
+    __call__ = forward
+
+
+def prefill(batch_scheduler, batch, ids):
+    input_ids = torch.tensor([ids])
+    attention_mask = torch.ones_like(input_ids)
+    outputs = shared.model(**scheduler._model_inputs(input_ids, None, attention_mask), return_dict=True)
+    seq = SimpleNamespace(ids=torch.tensor(ids), finished=False, sample=lambda logits: logits.argmax(-1))
+    batch_scheduler._join(batch, outputs.past_key_values, attention_mask)
+    batch.active.append(seq)
+    batch_scheduler._append_token(batch, seq, seq.sample(outputs.logits[:, -1, :]))
+    return seq
+
+
+def append_token(self, batch, seq, token):
+    seq.ids = torch.cat((seq.ids, token.view(1)))
+
+
+def cache(batch):
+    keys, values = batch.past_key_values[0]
+    return keys[:, 0, :, 0].long().tolist(), values[:, 0, :, 0].long().tolist()
+
+
+def make_batch():
+    shared.model = CountingModel()
+    batch_scheduler = scheduler.BatchScheduler.__new__(scheduler.BatchScheduler)
+    batch = scheduler._ModelBatch('stub')
+    return batch_scheduler, batch
+
+
+@mock.patch.object(scheduler.BatchScheduler, '_append_token', append_token)
+def test_join_left_pads_the_shorter_sequence():
+    batch_scheduler, batch = make_batch()
+    a = prefill(batch_scheduler, batch, [1, 2, 3])
+    b = prefill(batch_scheduler, batch, [11, 12, 13, 14, 15])
+
+    assert batch.attention_mask.tolist() == [[0, 0, 1, 1, 1], [1, 1, 1, 1, 1]]
+    keys, values = cache(batch)
+    assert keys == [[0, 0, 0, 1, 2], [0, 1, 2, 3, 4]]
+    assert values == [[0, 0, 1, 2, 3], [11, 12, 13, 14, 15]]
+    assert a.ids.tolist() == [1, 2, 3, 4]
+    assert b.ids.tolist() == [11, 12, 13, 14, 15, 16]
+
+
+@mock.patch.object(scheduler.BatchScheduler, '_append_token', append_token)
+def test_step_counts_positions_without_the_padding():
+    batch_scheduler, batch = make_batch()
+    a = prefill(batch_scheduler, batch, [1, 2, 3])
+    b = prefill(batch_scheduler, batch, [11, 12, 13, 14, 15])
+    batch_scheduler._step(batch)
+    batch_scheduler._step(batch)
+
+    keys, values = cache(batch)
+    assert keys == [[0, 0, 0, 1, 2, 3, 4], [0, 1, 2, 3, 4, 5, 6]]
+    assert values == [[0, 0, 1, 2, 3, 4, 5], [11, 12, 13, 14, 15, 16, 17]]
+    assert a.ids.tolist() == [1, 2, 3, 4, 5, 6]
+    assert b.ids.tolist() == [11, 12, 13, 14, 15, 16, 17, 18]
+
+
+@mock.patch.object(scheduler.BatchScheduler, '_append_token', append_token)
+def test_evict_drops_the_finished_sequence_and_its_padding():
+    batch_scheduler, batch = make_batch()
+    a = prefill(batch_scheduler, batch, [1, 2, 3])
+    b = prefill(batch_scheduler, batch, [11, 12, 13, 14, 15])
+    batch_scheduler._step(batch)
+
+    b.finished = True
+    batch_scheduler._evict_finished(batch)
+    assert batch.active == [a]
+    assert batch.attention_mask.tolist() == [[1, 1, 1, 1]]
+    assert cache(batch) == ([[0, 1, 2, 3]], [[1, 2, 3, 4]])
+
+    batch_scheduler._step(batch)
+    assert cache(batch) == ([[0, 1, 2, 3, 4]], [[1, 2, 3, 4, 5]])
+    assert a.ids.tolist() == [1, 2, 3, 4, 5, 6]
+
+    a.finished = True
+    batch_scheduler._evict_finished(batch)
+    assert batch.active == [] and batch.past_key_values is None
+
+
+def test_batching_needs_positions_from_the_mask():
+    assert scheduler.supports_padding(CountingModel())
+
+    class NoPositions:
+        config = SimpleNamespace(model_type='gpt_neox')
+
+        def forward(self, input_ids, past_key_values=None, attention_mask=None):
+            pass
+
+    assert not scheduler.supports_padding(NoPositions())
+    NoPositions.config.model_type = 'opt'
+    assert scheduler.supports_padding(NoPositions())
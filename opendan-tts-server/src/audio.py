@@ -0,0 +1,12 @@
+import io
+
+import numpy as np
+import soundfile as sf
+
+
+# Encodes the samples to OGG/Opus in memory, with the libsndfile bundled with soundfile.
+# Opus only takes 8, 12, 16, 24 and 48 kHz, Bark's 24 kHz is one of them.
+def encode_ogg(audio_array, sample_rate):
+    buf = io.BytesIO()
+    sf.write(buf, np.asarray(audio_array, dtype=np.float32), sample_rate, format="OGG", subtype="OPUS")
+    return buf.getvalue()
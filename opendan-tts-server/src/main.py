@@ -1,49 +1,134 @@
 from fastapi import FastAPI
+from fastapi.responses import JSONResponse, StreamingResponse
 import schemas
 import uvicorn
 from starlette.middleware.cors import CORSMiddleware
 from functions import *
+from tts_cache import AudioCache
+from audio import encode_ogg
+import asyncio
 import base64
+import json
 import os
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 from bark import SAMPLE_RATE, generate_audio, preload_models
-import soundfile as sf
-import wave
+from bark.generation import _load_history_prompt
 import numpy as np
 import nltk
+import torch
 
 # fastapi port
 server_port = 6006
 
+voice = {"history_prompt": "en_speaker_8", "text_temp": 0.6, "waveform_temp": 0.6}
+
+# Stock phrases and greetings come back all the time, keep their audio
+audio_cache = AudioCache(memory_bytes=int(os.getenv("TTS_CACHE_MEMORY_MB", "64")) * 1024 * 1024,
+                         disk_bytes=int(os.getenv("TTS_CACHE_DISK_MB", "512")) * 1024 * 1024,
+                         disk_dir=os.getenv("TTS_CACHE_DIR", "tts-cache"))
+
+# Speaker prompts loaded at startup (comma separated), so that generate_audio doesn't read them from disk every time
+preload_voices = [v for v in os.getenv("TTS_PRELOAD_VOICES", voice["history_prompt"]).split(",") if v]
+speaker_prompts = {}
+ready = False
+
 # Preload model
 preload_models()
 
+
+# The workers share Bark's weights, but every pass needs about 2 GB more of GPU memory
+# for its activations: as many workers as the free memory left after loading allows, up to 4
+def default_tts_workers(pass_bytes=2 * 1024 ** 3):
+    if torch.cuda.is_available():
+        free_bytes, _ = torch.cuda.mem_get_info()
+        return max(1, min(4, free_bytes // pass_bytes))
+
+    return max(1, min(4, (os.cpu_count() or 1) // 4))
+
+
+# Number of sentences synthesized at the same time, by all the requests together
+tts_workers = int(os.getenv("TTS_WORKERS", "0")) or default_tts_workers()
+print(f"{tts_workers} synthesis workers")
+
 app = FastAPI(docs_url=None, redoc_url=None)
 
+# Bark, the cache reads from disk and the OGG encoding run here, never on the event loop
+synthesis_executor = ThreadPoolExecutor(max_workers=tts_workers, thread_name_prefix="bark")
+cache_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="cache")
+encode_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="encode")
+
 # Set allowed access domain names
 origins = ["*"]  # set to "*" means all.
 
 
-def concatenate_wavs(wav_files, output_file, silence_duration=0.3):
-    wavs = [wave.open(f, 'rb') for f in wav_files]
-    sampwidth = wavs[0].getsampwidth()
-    framerate = wavs[0].getframerate()
-    nchannels = wavs[0].getnchannels()
+# The preloaded speaker prompt is passed instead of its name when there is one
+def generation_params():
+    return dict(voice, history_prompt=speaker_prompts.get(voice["history_prompt"], voice["history_prompt"]))
+
+
+def synthesize(sentence):
+    audio_array = generate_audio(sentence, **generation_params())
+    audio_cache.put(AudioCache.key(sentence, **voice), audio_array)
+    return audio_array
+
+
+def load_speaker_prompt(name):
+    prompt = _load_history_prompt(name)
+    return {k: prompt[k] for k in prompt.keys()}
+
+
+# Loads the speaker prompts and runs a short synthesis, so that the first user doesn't pay for the lazy loading
+def warm_up():
+    global ready
+    time_start = time.time()
+    for name in preload_voices:
+        try:
+            speaker_prompts[name] = load_speaker_prompt(name)
+        except Exception:
+            print(f"failed to preload speaker prompt {name}")
+            traceback.print_exc()
+
+    try:
+        generate_audio("Hello.", **generation_params())
+    except Exception:
+        print("warm-up synthesis failed")
+        traceback.print_exc()
+        return
+
+    ready = True
+    print(f"warm-up done in {time.time() - time_start:.2f}s")
+
+
+@app.on_event("startup")
+async def start_warm_up():
+    # Runs on the synthesis pool, requests that arrive in the meantime wait behind it
+    asyncio.get_running_loop().run_in_executor(synthesis_executor, warm_up)
 
-    samples = [wav.readframes(wav.getnframes()) for wav in wavs]
-    total_frames = sum(len(s) for s in samples) + int(silence_duration * framerate * nchannels * sampwidth)
 
-    output = wave.open(output_file, 'wb')
-    output.setparams((nchannels, sampwidth, framerate, total_frames, 'NONE', 'Uncompressed'))
+# Sentences that were already synthesized come from the cache (read on cache_executor, it may hit the disk)
+async def cached_or_synthesized(sentence):
+    loop = asyncio.get_running_loop()
+    audio_array = await loop.run_in_executor(cache_executor, audio_cache.get, AudioCache.key(sentence, **voice))
+    if audio_array is None:
+        audio_array = await loop.run_in_executor(synthesis_executor, synthesize, sentence)
+    return audio_array
 
-    for s in samples:
-        output.writeframes(s)
-        silence_frame = np.zeros((int(silence_duration * framerate), 2)).astype(np.int16).tobytes()
-        for i in range(int(nchannels / 2)):
-            output.writeframes(silence_frame)
 
-    output.close()
+# Starts every sentence at once, so they are spread over the workers
+def submit_sentences(sentences):
+    return [asyncio.ensure_future(cached_or_synthesized(s)) for s in sentences]
+
+
+# Puts the sentences end to end, each one followed by a short silence
+def concatenate_audio(audio_arrays, silence_duration=0.3):
+    silence = np.zeros(int(silence_duration * SAMPLE_RATE), dtype=np.float32)
+    parts = []
+    for audio_array in audio_arrays:
+        parts.append(audio_array.astype(np.float32, copy=False))
+        parts.append(silence)
+    return np.concatenate(parts)
 
 
 # Set cross domain parameter transfer
@@ -62,32 +147,14 @@ async def tts_bark(item: schemas.generate_web):
     print(f"{text=}")
     try:
         sentences = nltk.sent_tokenize(text)
-        idx = 1
-        wavs = []
-        for s in sentences:
-            audio_array = generate_audio(s, history_prompt="en_speaker_8", text_temp=0.6, waveform_temp=0.6)
-            fname = f"tmp-{idx}.wav"
-            sf.write(fname, audio_array, SAMPLE_RATE)
-            idx += 1
-            wavs.append(fname)
-        file_name_pre = f"out-{time.time()}"
-        file_name_wav = file_name_pre + ".wav"
-        file_name_ogg = file_name_pre + ".ogg"
-        concatenate_wavs(wavs, file_name_wav)
-
-        # convert to OGG
-        os.system("ffmpeg -i " + file_name_wav + " -c:a libopus -b:a 64k -y " + file_name_ogg)
-
-        with open(file_name_ogg, "rb") as f:
-            audio_content = f.read()
+        audio_arrays = await asyncio.gather(*submit_sentences(sentences))
+        audio_content = await asyncio.get_running_loop().run_in_executor(encode_executor, encode_ogg, concatenate_audio(audio_arrays), SAMPLE_RATE)
         base64_audio = base64.b64encode(audio_content).decode("utf-8")
         res = {"file_base64": base64_audio,
                "audio_text": text,
-               "file_name": file_name_ogg,
+               "file_name": f"out-{time.time()}.ogg",
                }
         print_log(item, res, time_start)
-        os.remove(file_name_wav)
-        os.remove(file_name_ogg)
 
         return res
     except Exception as err:
@@ -95,6 +162,51 @@ async def tts_bark(item: schemas.generate_web):
         print_log(item, res, time_start)
         return res
 
+# Same as /tts_bark/, but every sentence is sent as soon as it is synthesized:
+# one json object per line, each with a playable OGG of its own sentence.
+@app.post("/tts_bark_stream/")
+async def tts_bark_stream(item: schemas.generate_web):
+    time_start = time.time()
+    text = item.text
+    print(f"{text=}")
+
+    async def stream():
+        futures = []
+        try:
+            sentences = nltk.sent_tokenize(text)
+            futures = submit_sentences(sentences)
+            for idx, s in enumerate(sentences):
+                audio_array = await futures[idx]
+                audio_content = await asyncio.get_running_loop().run_in_executor(encode_executor, encode_ogg, audio_array, SAMPLE_RATE)
+                res = {"index": idx,
+                       "count": len(sentences),
+                       "audio_text": s,
+                       "file_base64": base64.b64encode(audio_content).decode("utf-8"),
+                       }
+                print(f"sentence {idx + 1}/{len(sentences)} ready after {time.time() - time_start:.2f}s")
+                yield json.dumps(res) + "\n"
+            print_log(item, {"audio_text": text, "sentences": len(sentences)}, time_start)
+        except Exception as err:
+            res = {"code": 9, "msg": "api error", "err": str(err), "traceback": traceback.format_exc()}
+            print_log(item, res, time_start)
+            yield json.dumps(res) + "\n"
+        finally:
+            # The client went away: drop the sentences that haven't started yet
+            for future in futures:
+                future.cancel()
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+@app.get("/health")
+async def health():
+    if not ready:
+        return JSONResponse({"status": "warming up"}, status_code=503)
+    return {"status": "ready"}
+
+@app.get("/tts_cache/")
+async def tts_cache_stats():
+    return audio_cache.get_stats()
+
 if __name__ == '__main__':
 
     print_env(server_port)
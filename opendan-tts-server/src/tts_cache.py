@@ -0,0 +1,132 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+def normalize_text(text):
+    return " ".join(text.split())
+
+
+class AudioCache:
+    """
+    Content addressed cache of synthesized sentences.
+
+    Entries are keyed by a hash of the normalized sentence and of the
+    generation parameters (voice, temperatures), with two LRU tiers: numpy
+    arrays in memory, and .npy files on disk that survive restarts.
+    """
+
+    def __init__(self, memory_bytes, disk_bytes, disk_dir):
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.disk_dir = disk_dir
+        self.memory = OrderedDict()
+        self.memory_size = 0
+        self.disk = OrderedDict()
+        self.disk_size = 0
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+        self.lock = threading.Lock()
+
+        if self.disk_bytes > 0:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            # Oldest first, so that the LRU order survives a restart
+            files = [os.path.join(self.disk_dir, f) for f in os.listdir(self.disk_dir) if f.endswith(".npy")]
+            # Left behind by writes that were interrupted
+            for f in os.listdir(self.disk_dir):
+                if f.endswith(".tmp"):
+                    os.remove(os.path.join(self.disk_dir, f))
+            for path in sorted(files, key=os.path.getmtime):
+                size = os.path.getsize(path)
+                self.disk[os.path.basename(path)[:-len(".npy")]] = size
+                self.disk_size += size
+            self._evict_disk()
+
+    @staticmethod
+    def key(text, **generation_params):
+        data = json.dumps([normalize_text(text), generation_params], sort_keys=True)
+        return hashlib.blake2b(data.encode("utf-8"), digest_size=16).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.disk_dir, key + ".npy")
+
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return self.memory[key]
+
+            on_disk = key in self.disk
+            if on_disk:
+                self.disk.move_to_end(key)
+
+        if on_disk:
+            try:
+                audio_array = np.load(self._path(key))
+                os.utime(self._path(key))
+            except (OSError, ValueError):
+                audio_array = None
+                with self.lock:
+                    self.disk_size -= self.disk.pop(key, 0)
+
+            if audio_array is not None:
+                with self.lock:
+                    self.stats["disk_hits"] += 1
+                    self._put_memory(key, audio_array)
+                return audio_array
+
+        with self.lock:
+            self.stats["misses"] += 1
+        return None
+
+    def put(self, key, audio_array):
+        with self.lock:
+            self._put_memory(key, audio_array)
+            store = self.disk_bytes > 0 and key not in self.disk and audio_array.nbytes <= self.disk_bytes
+
+        if store:
+            # Written under a temporary name of its own first, so a crash never leaves a truncated
+            # entry and two requests synthesizing the same sentence don't write to the same file
+            with tempfile.NamedTemporaryFile(dir=self.disk_dir, suffix=".tmp", delete=False) as f:
+                tmp_path = f.name
+                try:
+                    np.save(f, audio_array)
+                except Exception:
+                    f.close()
+                    os.remove(tmp_path)
+                    raise
+            os.replace(tmp_path, self._path(key))
+            size = os.path.getsize(self._path(key))
+            with self.lock:
+                # The other request may have counted it already
+                self.disk_size += size - self.disk.get(key, 0)
+                self.disk[key] = size
+                self.disk.move_to_end(key)
+                self._evict_disk()
+
+    def _put_memory(self, key, audio_array):
+        if key in self.memory or audio_array.nbytes > self.memory_bytes:
+            return
+
+        self.memory[key] = audio_array
+        self.memory_size += audio_array.nbytes
+        while self.memory_size > self.memory_bytes:
+            self.memory_size -= self.memory.popitem(last=False)[1].nbytes
+
+    def _evict_disk(self):
+        while self.disk_size > self.disk_bytes:
+            key, size = self.disk.popitem(last=False)
+            self.disk_size -= size
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats, memory_entries=len(self.memory), memory_bytes=self.memory_size, disk_entries=len(self.disk), disk_bytes=self.disk_size)
@@ -0,0 +1,26 @@
+import io
+import sys
+from pathlib import Path
+
+import numpy as np
+import soundfile as sf
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from audio import encode_ogg
+
+
+def test_encode_ogg_decodes_back():
+    sample_rate = 24000
+    t = np.arange(sample_rate) / sample_rate
+    audio_array = (0.5 * np.sin(2 * np.pi * 440 * t)).astype(np.float32)
+
+    data = encode_ogg(audio_array, sample_rate)
+    assert data[:4] == b"OggS"
+
+    decoded, decoded_rate = sf.read(io.BytesIO(data), dtype="float32")
+    assert decoded_rate == sample_rate
+    assert decoded.ndim == 1
+    assert abs(len(decoded) - len(audio_array)) < sample_rate // 10
+    n = min(len(decoded), len(audio_array))
+    assert np.corrcoef(decoded[1000:n], audio_array[1000:n])[0, 1] > 0.9
@@ -0,0 +1,32 @@
+import os
+import sys
+import threading
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from tts_cache import AudioCache
+
+
+def test_concurrent_puts_of_the_same_sentence_are_counted_once(tmp_path):
+    cache = AudioCache(memory_bytes=0, disk_bytes=1024 * 1024, disk_dir=str(tmp_path))
+    key = AudioCache.key("Hello there.", history_prompt="en_speaker_8")
+    audio_array = np.zeros(24000, dtype=np.float32)
+
+    barrier = threading.Barrier(8)
+
+    def put():
+        barrier.wait()
+        cache.put(key, audio_array)
+
+    threads = [threading.Thread(target=put) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert os.listdir(tmp_path) == [key + ".npy"]
+    assert cache.disk_size == os.path.getsize(tmp_path / (key + ".npy"))
+    np.testing.assert_array_equal(cache.get(key), audio_array)